@@ -4,17 +4,21 @@ import sys
 import flask_cors
 import flask_limiter.util
 import werkzeug.exceptions
-from flask import Flask, jsonify
+from flask import Flask, g, jsonify, request
 from flask_redis import FlaskRedis
 
+from app.catalog import Catalog, init_catalog
+from app import events
 from app.config import Config
-from app.services import VideoService, init_video_service
+from app.media import StreamLimiter
+from app.offload import Offloader
+from app.sampling import SamplingProfiler
 
 # Services
 
 redis_app = FlaskRedis()
 
-video_service = VideoService()
+catalog = Catalog()
 
 limiter = flask_limiter.Limiter(
     key_func=flask_limiter.util.get_remote_address,
@@ -23,6 +27,35 @@ limiter = flask_limiter.Limiter(
 
 cors = flask_cors.CORS()
 
+offloader = Offloader()
+
+event_hub = events.EventHub()
+
+profiler = SamplingProfiler()
+
+stream_limiter = StreamLimiter()
+
+# API results that become outdated by each event type
+INVALIDATED_BY_EVENT = {
+    events.TIMELAPSE_SLOT: ('timelapses', 'stats'),
+    events.TIMELAPSE_DAILY: ('timelapses', 'stats'),
+    events.TIMELAPSE_ROLLUP: ('timelapses',),
+    events.ARCHIVE_DONE: ('coverage', 'clips', 'stats'),
+    events.CHUNK_CLOSED: ('coverage', 'stats'),
+    events.WATCHDOG_RESTART: ('stats',),
+}
+
+
+def __getattr__(name):
+    """Creates a video service for celery workers on first access.
+    The web process never touches it, so it does not import boto3 and psutil"""
+    if name == 'video_service':
+        from app.services import VideoService
+        globals()['video_service'] = VideoService()
+        return globals()['video_service']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # Error handlers
 
 
@@ -36,6 +69,17 @@ def errhandler_universal_json(error):
     return jsonify({'message': str(error)}), 500
 
 
+# Profiling hooks
+
+
+def start_request_profile():
+    g.profile_run = profiler.start('api', request.endpoint or request.path)
+
+
+def finish_request_profile(_):
+    profiler.finish(g.pop('profile_run', None))
+
+
 def create_app():
     app = Flask(__name__)
 
@@ -68,11 +112,30 @@ def create_app():
 
     app.logger.info("Starting app")
 
-    init_video_service(video_service, app.config)
-    video_service.init_app(redis_app)
+    init_catalog(catalog, app.config)
+    catalog.init_app(redis_app)
 
+    # every gunicorn worker would count its own limits in memory
+    if not app.config['RATELIMIT_STORAGE_URL']:
+        app.config['RATELIMIT_STORAGE_URL'] = app.config['REDIS_URL']
     limiter.init_app(app)
 
+    offloader.init_app(app)
+
+    event_hub.init_app(redis_app, int(app.config['EVENTS_MAX_STREAMS']),
+                       int(app.config['EVENTS_CLIENT_STREAMS']))
+    event_hub.add_listener(lambda event: offloader.invalidate(*INVALIDATED_BY_EVENT.get(event['type'], ())))
+    # subscribe in a serving process, not in a parent that forks workers
+    app.before_first_request(event_hub.start)
+
+    stream_limiter.init_app(app, redis_app)
+
+    profiler.init_config(app.config)
+    if profiler.enabled:
+        app.logger.info(f"Profiling sampled requests to {profiler.path}")
+        app.before_request(start_request_profile)
+        app.teardown_request(finish_request_profile)
+
     cors_resources = {r"/api/health": {"origins": "*"}}
     if app.config['CORS_ORIGIN']:
         cors_resources[r"/api/*"] = {"origins": [s.strip() for s in app.config['CORS_ORIGIN'].split(',')]}
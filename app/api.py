@@ -1,12 +1,16 @@
 import datetime
+import json
 import os
+import queue
+import re
 
 import bleach
 import werkzeug.exceptions
-from flask import jsonify, Blueprint, current_app, redirect
+from flask import jsonify, Blueprint, Response, current_app, g, redirect, request, send_from_directory, url_for
 
-from app import video_service, limiter, redis_app
-from app.services import StatsService
+from app import catalog, event_hub, limiter, offloader, profiler, redis_app, stream_limiter
+from app.catalog import ROLLUP_PERIODS, StatsService
+from app.jobs import summarize
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
@@ -24,6 +28,23 @@ def str_to_bool(value: str) -> bool:
     raise ValueError("Invalid literal for boolean(): {0}".format(value))
 
 
+def offloaded(endpoint: str, key: tuple, func):
+    """Calls func off the request thread. A sampled request profiles it in a worker thread too"""
+    run = g.get('profile_run')
+    return offloader.call(endpoint, key, run.follow(func) if run else func)
+
+
+def offloaded_json(endpoint: str, key: tuple, func):
+    """Makes a JSON response from a result computed off the request thread.
+    Stale results are marked with Age and Warning headers"""
+    value, age = offloaded(endpoint, key, func)
+    response = jsonify(value)
+    if age is not None:
+        response.headers['Age'] = str(int(age))
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
 @bp.route('/health', methods=['GET'])
 @limiter.exempt
 def health():
@@ -35,31 +56,107 @@ def health():
 @limiter.limit("1 per second")
 def stats():
     """Reports a service stats"""
-    stats_dict = StatsService(redis_app).collect_stats(video_service)
-    return jsonify(stats_dict)
+    return offloaded_json('stats', (), lambda: StatsService(redis_app).collect_stats(catalog))
+
+
+@bp.route('/events', methods=['GET'])
+@limiter.limit("10 per minute")
+def events():
+    """Streams catalog change events as Server-Sent Events"""
+    subscription = event_hub.subscribe(request.remote_addr or 'unknown')
+
+    def stream():
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event = subscription.get(timeout=15)
+            except queue.Empty:
+                # keep proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+            yield 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event))
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # a server closes a response when a client goes away, even if the stream has not started
+    response.call_on_close(lambda: event_hub.unsubscribe(subscription))
+    return response
 
 
 @bp.route('/hello', methods=['POST'])
 @limiter.limit("1 per minute")
 def hello():
     """Debug task"""
+    from celery.exceptions import TimeoutError
     from app.tasks import hello_task
-    res = hello_task.delay().get()
+    try:
+        res = hello_task.delay().get(timeout=current_app.config['API_HELLO_TIMEOUT'])
+    except TimeoutError:
+        raise werkzeug.exceptions.GatewayTimeout("No answer from workers")
     return jsonify(result=repr(res))
 
 
+@bp.route('/jobs/history', methods=['GET'])
+def jobs_history():
+    """Reports resources used by recent child processes and their summary per job stage"""
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest("Wrong limit")
+    limit = max(1, min(limit, current_app.config['JOBS_HISTORY_SIZE']))
+
+    def collect():
+        entries = catalog.jobs_history(limit)
+        return dict(summary=summarize(entries), jobs=entries)
+
+    return offloaded_json('jobs', (limit,), collect)
+
+
 @bp.route('/timelapses', methods=['GET'])
 def timelapses():
     """Returns a list of available hourly and daily timelapses"""
-    res = {}
-    for file, dt, slot in video_service.provide_timelapse_slots():
-        res.setdefault(dt.strftime("%Y%m%d"), {})
-        res[dt.strftime("%Y%m%d")].setdefault('slots', []).append(slot)
-        res[dt.strftime("%Y%m%d")]['daily'] = False
-    for file, dt in video_service.provide_timelapse_daily():
-        res.setdefault(dt.strftime("%Y%m%d"), {})
-        res[dt.strftime("%Y%m%d")]['daily'] = True
-    return jsonify(res)
+
+    def collect():
+        res = {}
+        for file, dt, slot in catalog.provide_timelapse_slots():
+            res.setdefault(dt.strftime("%Y%m%d"), {})
+            res[dt.strftime("%Y%m%d")].setdefault('slots', []).append(slot)
+            res[dt.strftime("%Y%m%d")]['daily'] = False
+        for file, dt in catalog.provide_timelapse_daily():
+            res.setdefault(dt.strftime("%Y%m%d"), {})
+            res[dt.strftime("%Y%m%d")]['daily'] = True
+        return res
+
+    return offloaded_json('timelapses', (), collect)
+
+
+def timelapse_location(filepath: str) -> str:
+    """Returns a URL of a timelapse served by the media endpoint or by a proxy at TIMELAPSES_URL_PREFIX"""
+    if current_app.config['ENABLE_MEDIA']:
+        return url_for('api.media', kind='timelapses', name=os.path.basename(filepath))
+    return '{}/{}'.format(current_app.config['TIMELAPSES_URL_PREFIX'].rstrip('/'), os.path.basename(filepath))
+
+
+def missing_timelapse(date: datetime.date, slot, is_producible):
+    """Queues urgent generation of a missing but producible timelapse.
+    Returns 202 with a status URL polled until it redirects to a video"""
+    if not current_app.config['ENABLE_URGENT_TIMELAPSES']:
+        raise werkzeug.exceptions.NotFound("Timelapse not found")
+    state = catalog.urgent_state(date, slot)
+    if state and state.startswith('error'):
+        raise werkzeug.exceptions.NotFound("Timelapse cannot be made, " + state)
+    if state:
+        # a job waiting in the queue must not be requested again once its state expires
+        catalog.touch_urgent(date, slot)
+    else:
+        producible, _ = offloaded('producible', (date, slot), is_producible)
+        if not producible:
+            raise werkzeug.exceptions.NotFound("Timelapse not found")
+        if catalog.request_urgent(date, slot):
+            from app.tasks import urgent_timelapse_task
+            urgent_timelapse_task.apply_async(args=[date.strftime('%Y%m%d'), slot], queue='urgent')
+            current_app.logger.info(f"Queued urgent timelapse for {date.isoformat()} slot {slot}")
+    return jsonify(status=state or 'queued'), 202, {'Location': request.path}
 
 
 @bp.route('/timelapses/<string:date>/hourly/<int:slot>', methods=['GET'])
@@ -73,13 +170,11 @@ def timelapses_hourly(date, slot):
         raise werkzeug.exceptions.BadRequest("Wrong date passed, should be YYYYMMDD")
     if not slot or slot < 1 or slot > 8:
         raise werkzeug.exceptions.BadRequest("Wrong slot, should be in [1;8]")
-    filepath = video_service.get_timelapses_for_slot(dt, slot)
+    filepath, _ = offloaded('timelapses', (dt, slot), lambda: catalog.get_timelapses_for_slot(dt, slot))
     if not filepath:
-        raise werkzeug.exceptions.NotFound("Timelapse not found")
+        return missing_timelapse(dt, slot, lambda: catalog.is_slot_producible(dt, slot))
     current_app.logger.info(f"Found timelapse at {filepath}")
-    location = '{}/{}'.format(current_app.config['TIMELAPSES_URL_PREFIX'].rstrip('/'),
-                              os.path.basename(filepath))
-    return redirect(location=location, code=302)
+    return redirect(location=timelapse_location(filepath), code=302)
 
 
 @bp.route('/timelapses/<string:date>/daily', methods=['GET'])
@@ -91,10 +186,114 @@ def timelapses_daily(date):
         dt = datetime.datetime.strptime(date_str, "%Y%m%d").date()
     except ValueError:
         raise werkzeug.exceptions.BadRequest("Wrong date passed, should be YYYYMMDD")
-    filepath = video_service.get_timelapses_for_date(dt)
+    filepath, _ = offloaded('timelapses', (dt,), lambda: catalog.get_timelapses_for_date(dt))
+    if not filepath:
+        return missing_timelapse(dt, None, lambda: catalog.is_day_producible(dt))
+    current_app.logger.info(f"Found timelapse at {filepath}")
+    return redirect(location=timelapse_location(filepath), code=302)
+
+
+@bp.route('/timelapses/<string:period>', methods=['GET'])
+def timelapses_rollups(period):
+    """Returns a list of available weekly or monthly timelapses with days they contain"""
+    if period not in ROLLUP_PERIODS:
+        raise werkzeug.exceptions.NotFound("Wrong period, should be weekly or monthly")
+
+    def collect():
+        return {key: {'days': catalog.rollup_days(os.path.basename(file))}
+                for file, key in catalog.provide_timelapse_rollups(period)}
+
+    return offloaded_json('timelapses', (period,), collect)
+
+
+@bp.route('/timelapses/<string:period>/<string:key>', methods=['GET'])
+def timelapses_rollup(period, key):
+    """Redirects to a videofile for given weekly (YYYYWww) or monthly (YYYYMM) timelapse"""
+    key_str = bleach.clean(key)
+    current_app.logger.info(f"Request timelapses_rollup for {period} {key_str}")
+    if period not in ROLLUP_PERIODS:
+        raise werkzeug.exceptions.NotFound("Wrong period, should be weekly or monthly")
+    if not re.fullmatch(r'\d{4}W\d{2}' if period == 'weekly' else r'\d{6}', key_str):
+        raise werkzeug.exceptions.BadRequest("Wrong key passed, should be YYYYWww or YYYYMM")
+    filepath, _ = offloaded('timelapses', (period, key_str), lambda: catalog.get_timelapse_rollup(period, key_str))
     if not filepath:
         raise werkzeug.exceptions.NotFound("Timelapse not found")
     current_app.logger.info(f"Found timelapse at {filepath}")
-    location = '{}/{}'.format(current_app.config['TIMELAPSES_URL_PREFIX'].rstrip('/'),
-                              os.path.basename(filepath))
-    return redirect(location=location, code=302)
+    return redirect(location=timelapse_location(filepath), code=302)
+
+
+@bp.route('/media/<string:kind>/<string:name>', methods=['GET'])
+@limiter.exempt
+def media(kind, name):
+    """Serves a timelapse or a temporary archive with byte ranges for deployments without a proxy.
+    Players issue many range requests, so concurrent streams are limited instead of a request rate"""
+    if not current_app.config['ENABLE_MEDIA']:
+        raise werkzeug.exceptions.NotFound("Media serving is disabled")
+    roots = {'timelapses': ('timelapse-', catalog.timelapse_path), 'archives': ('archive-', catalog.tmp_path)}
+    if kind not in roots or not re.fullmatch(re.escape(roots[kind][0]) + r'[\w-]+\.(mp4|mkv)', name):
+        raise werkzeug.exceptions.NotFound("Media not found")
+    rollup = any(name.startswith(f'timelapse-{period}-') for period in ROLLUP_PERIODS)
+    try:
+        return stream_limiter.serve(os.path.join(roots[kind][1], name), immutable=not rollup)
+    except FileNotFoundError:
+        raise werkzeug.exceptions.NotFound("Media not found")
+
+
+@bp.route('/coverage', methods=['GET'])
+def coverage():
+    """Returns covered and missing intervals of a day in epoch milliseconds"""
+    date_str = bleach.clean(request.args.get('date', ''))
+    try:
+        dt = datetime.datetime.strptime(date_str, "%Y%m%d").date()
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest("Wrong date passed, should be YYYYMMDD")
+    return offloaded_json('coverage', (dt,), lambda: catalog.coverage(dt))
+
+
+@bp.route('/clips', methods=['GET'])
+def clips():
+    """Redirects to a clip for given interval, starting its extraction if needed"""
+    from_str = bleach.clean(request.args.get('from', ''))
+    to_str = bleach.clean(request.args.get('to', ''))
+    current_app.logger.info(f"Request clip from {from_str} to {to_str}")
+    try:
+        from_dt = datetime.datetime.strptime(from_str, "%Y%m%dT%H%M%S")
+        to_dt = datetime.datetime.strptime(to_str, "%Y%m%dT%H%M%S")
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest("Wrong interval passed, should be YYYYMMDDTHHMMSS")
+    if to_dt <= from_dt or to_dt - from_dt > datetime.timedelta(minutes=current_app.config['CLIPS_MAX_MINUTES']):
+        raise werkzeug.exceptions.BadRequest("Wrong interval length")
+
+    filepath, _ = offloaded('clips', (from_dt, to_dt), lambda: catalog.get_clip(from_dt, to_dt))
+    if filepath:
+        current_app.logger.info(f"Found clip at {filepath}")
+        location = '{}/{}'.format(current_app.config['CLIPS_URL_PREFIX'].rstrip('/'),
+                                  os.path.basename(filepath))
+        return redirect(location=location, code=302)
+
+    state = catalog.clip_state(from_dt, to_dt)
+    if state and state.startswith('error'):
+        raise werkzeug.exceptions.NotFound("Clip cannot be made, " + state)
+    if not state and catalog.request_clip(from_dt, to_dt):
+        from app.tasks import clip_task
+        clip_task.apply_async(args=[from_str, to_str], queue='fast')
+        state = 'queued'
+    return jsonify(status=state or 'queued'), 202, {'Location': request.full_path}
+
+
+@bp.route('/debug/profiles', methods=['GET'])
+def debug_profiles():
+    """Lists sampled profiles of celery tasks and API requests, newest first"""
+    if not profiler.enabled:
+        raise werkzeug.exceptions.NotFound("Profiling is disabled")
+    entries, _ = offloaded('profiles', (), profiler.profiles)
+    return jsonify(profiles=[dict(entry, url=url_for('api.debug_profile', name=entry['name']))
+                             for entry in entries])
+
+
+@bp.route('/debug/profiles/<string:name>', methods=['GET'])
+def debug_profile(name):
+    """Downloads a pstats file"""
+    if not profiler.enabled:
+        raise werkzeug.exceptions.NotFound("Profiling is disabled")
+    return send_from_directory(profiler.path, name, as_attachment=True, mimetype='application/octet-stream')
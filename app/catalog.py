@@ -0,0 +1,457 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+from typing import Optional
+
+from app.chunks import ChunkIndex
+from app.jobs import JobHistory
+from app.leases import collect_singleton_stats
+from app.placement import FilePlacer
+from app.profiles import ProfileController
+from app.retention import UsageLedger
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_PERIODS = ('weekly', 'monthly')
+
+
+class Catalog:
+    """Read-only view of produced videos, chunks and statistics.
+    The web tier imports it alone, so it must not depend on boto3, psutil or celery"""
+
+    DECIMATION_KEY = 'parklapse.decimation'
+
+    def __init__(self, *args):
+        # extra RTSP streams have own directories below the primary ones, the primary stream has no name
+        self.stream = ''
+        if args:
+            self.init_config(*args)
+        self._redis = None
+        self._profiles = None
+        self._chunk_index = None
+        self._job_history = None
+        self._placer = None
+        self._usage = None
+
+    def init_app(self, redis):
+        self._redis = redis
+        self._chunk_index = ChunkIndex(redis, self.stream)
+        self._job_history = JobHistory(redis, self.config['JOBS_HISTORY_SIZE'])
+        self._placer = FilePlacer(redis)
+        self._usage = UsageLedger(redis)
+        if self.config['ENABLE_ADAPTIVE_PROFILES']:
+            self._profiles = ProfileController(redis, self.config)
+
+    @property
+    def redis(self):
+        return self._redis
+
+    # noinspection PyAttributeOutsideInit
+    def init_config(self, config,
+                    raw_capture_path, timelapse_path, tmp_path, archive_path, damaged_path):
+        self.config = config
+        self.raw_capture_path = raw_capture_path
+        self.timelapse_path = timelapse_path
+        self.tmp_path = tmp_path
+        self.archive_path = archive_path
+        self.damaged_path = damaged_path
+        if not self.raw_capture_path or not os.path.isdir(self.raw_capture_path):
+            raise RuntimeError('Bad raw_capture_path')
+        if not self.timelapse_path or not os.path.isdir(self.timelapse_path):
+            raise RuntimeError('Bad timelapse_path')
+        if not self.archive_path or not os.path.isdir(self.archive_path):
+            raise RuntimeError('Bad archive_path')
+        if not self.damaged_path or not os.path.isdir(self.damaged_path):
+            raise RuntimeError('Bad damaged_path')
+        if self.config['ENABLE_S3'] and not self.config['BUCKET_NAME']:
+            raise RuntimeError('No bucket name')
+
+    def _stream_path(self, path: str) -> str:
+        return os.path.join(path, 'streams', self.stream) if self.stream else path
+
+    def _stream_name(self, name: str) -> str:
+        """Qualifies an output name for Redis keys, names repeat in directories of other streams"""
+        return f'{self.stream}/{name}' if self.stream else name
+
+    def _enumerate_raw_files(self) -> list:
+        return list(sorted(file for file
+                           in glob.glob(self.raw_capture_path + '/*/*.mp4') +
+                           glob.glob(self.raw_capture_path + '/*/*.mkv')
+                           if os.path.isfile(file)))
+
+    @staticmethod
+    def _timelapse_slot(dt: datetime.datetime) -> int:
+        """Returns index of three-hour interval (1 to 9)"""
+        return (dt.hour // 3) + 1
+
+    def raw_count(self):
+        return len(self._enumerate_raw_files())
+
+    @staticmethod
+    def _parse_raw_dt(fname: str) -> datetime.datetime:
+        # out-20190602T1705.mp4
+        m = re.match(r'out-(.*)\.(mp4|mkv)', os.path.basename(fname))
+        if not m:
+            raise ValueError('Wrong filename')
+        return datetime.datetime.strptime(m.group(1), "%Y%m%dT%H%M")
+
+    @staticmethod
+    def _parse_timelapse_to_date_and_slot(fname: str) -> (datetime.date, int):
+        # timelapse-slots-20190602_3.mp4
+        m = re.match(r'timelapse-slots-(\d+)_(\d)\.(mp4|mkv)', os.path.basename(fname))
+        if not m:
+            raise ValueError('Wrong filename ' + fname)
+        date = datetime.datetime.strptime(m.group(1), "%Y%m%d").date()
+        slot = int(m.group(2))
+        # logger.debug(f"Res: {date!r} {slot!r}")
+        return date, slot
+
+    @staticmethod
+    def _parse_timelapse_daily_to_date(fname: str) -> datetime.date:
+        # timelapse-daily-20190602.mp4
+        m = re.match(r'timelapse-daily-(\d+)\.(mp4|mkv)', os.path.basename(fname))
+        if not m:
+            raise ValueError('Wrong filename ' + fname)
+        dt = datetime.datetime.strptime(m.group(1), "%Y%m%d").date()
+        # logger.debug(f"Res: {dt!r}")
+        return dt
+
+    def raw_last_at(self) -> Optional[datetime.datetime]:
+        files = self._enumerate_raw_files()
+        if len(files) < 2:
+            return None
+        last_completed_file = files[-1]
+        return self._parse_raw_dt(last_completed_file)
+
+    def timelapses_error_count(self):
+        return len([file for file
+                    in glob.glob(self.timelapse_path + '/*.err')
+                    if os.path.isfile(file)])
+
+    def timelapses_slots_count(self):
+        return len([file for file
+                    in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
+                    glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
+                    if os.path.isfile(file)])
+
+    def timelapses_daily_count(self):
+        return len([file for file
+                    in glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
+                    glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv')
+                    if os.path.isfile(file)])
+
+    def archives_count(self):
+        return len([file for file
+                    in glob.glob(self.archive_path + '/archive-*.ok')
+                    if os.path.isfile(file)])
+
+    def archives_error_count(self):
+        return len([file for file
+                    in glob.glob(self.archive_path + '/archive-*.err')
+                    if os.path.isfile(file)])
+
+    def timelapse_last_file(self):
+        files = sorted([file for file
+                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
+                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
+                        if os.path.isfile(file)])
+        if not files:
+            return None
+        return os.path.basename(files[-1])
+
+    def timelapse_last_at(self):
+        files = sorted([file for file
+                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
+                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
+                        if os.path.isfile(file)])
+        if not files:
+            return None
+        dt, _ = self._parse_timelapse_to_date_and_slot(files[-1])
+        return dt
+
+    def archive_last_file(self):
+        files = sorted([file for file
+                        in glob.glob(self.archive_path + '/archive-*.ok')
+                        if os.path.isfile(file)])
+        if not files:
+            return None
+        return os.path.basename(files[-1]).replace('.ok', '')
+
+    def is_slot_producible(self, date: datetime.date, slot: int) -> bool:
+        """Checks if a slot is over and has raw footage. The last chunk of a slot is closed within minutes"""
+        slot_end = datetime.datetime.combine(date, datetime.time()) + datetime.timedelta(hours=3 * slot)
+        if datetime.datetime.now() < slot_end + datetime.timedelta(minutes=11):
+            return False
+        return any(self._parse_raw_dt(file).date() == date and
+                   self._timelapse_slot(self._parse_raw_dt(file)) == slot
+                   for file in self._enumerate_raw_files())
+
+    def is_day_producible(self, date: datetime.date) -> bool:
+        """Checks if a day is over and has slot timelapses or raw footage"""
+        if date >= datetime.datetime.now().date():
+            return False
+        return any(dt == date for _, dt, _ in self.provide_timelapse_slots()) or \
+            any(self._parse_raw_dt(file).date() == date for file in self._enumerate_raw_files())
+
+    def _urgent_key(self, date: datetime.date, slot: Optional[int]) -> str:
+        return 'parklapse.urgent.' + (self._make_timelapse_video_base(date, slot) if slot
+                                      else self._make_timelapse_daily_video_base(date))
+
+    def urgent_state(self, date: datetime.date, slot: Optional[int]) -> Optional[str]:
+        state = self._redis.get(self._urgent_key(date, slot))
+        return state.decode('latin-1') if state else None
+
+    def request_urgent(self, date: datetime.date, slot: Optional[int]) -> bool:
+        """Marks a slot or a daily (no slot) timelapse as queued for urgent generation.
+        Returns False if it is already requested"""
+        return bool(self._redis.set(self._urgent_key(date, slot), 'queued',
+                                    nx=True, ex=self.config['URGENT_STATE_TTL']))
+
+    def touch_urgent(self, date: datetime.date, slot: Optional[int]):
+        """Keeps a state of a queued or running urgent timelapse while it is polled"""
+        self._redis.expire(self._urgent_key(date, slot), self.config['URGENT_STATE_TTL'])
+
+    def get_timelapses_for_slot(self, date: datetime.date, slot: int) -> Optional[str]:
+        files = sorted([file for file
+                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
+                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
+                        if os.path.isfile(file) and
+                        self._parse_timelapse_to_date_and_slot(file) == (date, slot)])
+        if not files:
+            return None
+        if len(files) > 1:
+            logger.warning(f"Multiple files matching slot {slot} and date {date.isoformat()} found")
+        return files[0]
+
+    def get_timelapses_for_date(self, date: datetime.date) -> Optional[str]:
+        files = sorted([file for file
+                        in glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
+                        glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv')
+                        if os.path.isfile(file) and
+                        self._parse_timelapse_daily_to_date(file) == date])
+        if not files:
+            return None
+        if len(files) > 1:
+            logger.warning(f"Multiple files matching date {date.isoformat()} found")
+        return files[0]
+
+    def jobs_history(self, limit: int) -> list:
+        return self._job_history.recent(limit)
+
+    def active_jobs(self) -> dict:
+        """Returns claimed jobs with their owner nodes"""
+        res = {}
+        for key in self._redis.scan_iter(match='parklapse.job.*'):
+            owner = self._redis.get(key)
+            if owner:
+                res[key.decode('latin-1')[len('parklapse.job.'):]] = owner.decode('latin-1').rpartition(':')[0]
+        return res
+
+    def placement_stats(self) -> Optional[dict]:
+        """Returns bytes placed by each strategy in MiB"""
+        return {k: v // (1024 * 1024) for k, v in self._placer.stats().items()} or None
+
+    def archive_peak_rss(self) -> Optional[dict]:
+        """Returns last and maximal peak RSS of archive jobs in MiB"""
+        rss = self._redis.hgetall('parklapse.archive.rss')
+        if not rss:
+            return None
+        return {k.decode('latin-1'): int(v) // 1024 for k, v in rss.items()}
+
+    def profile_stats(self) -> Optional[dict]:
+        return self._profiles.stats() if self._profiles else None
+
+    def coverage(self, date: datetime.date) -> dict:
+        return self._chunk_index.coverage(date)
+
+    @property
+    def clips_path(self) -> str:
+        if self.config.get('CLIPS_PATH'):
+            return self._stream_path(self.config['CLIPS_PATH'])
+        return os.path.join(self.tmp_path, 'clips')
+
+    @staticmethod
+    def _make_clip_name(from_dt: datetime.datetime, to_dt: datetime.datetime) -> str:
+        return "clip-{}-{}.mp4".format(from_dt.strftime('%Y%m%dT%H%M%S'), to_dt.strftime('%Y%m%dT%H%M%S'))
+
+    def get_clip(self, from_dt: datetime.datetime, to_dt: datetime.datetime) -> Optional[str]:
+        """Returns a cached clip path and marks it as recently used"""
+        clip_path = os.path.join(self.clips_path, self._make_clip_name(from_dt, to_dt))
+        if not os.path.isfile(clip_path):
+            return None
+        os.utime(clip_path)
+        return clip_path
+
+    def clip_state(self, from_dt: datetime.datetime, to_dt: datetime.datetime) -> Optional[str]:
+        state = self._redis.get('parklapse.clip.' + self._make_clip_name(from_dt, to_dt))
+        return state.decode('latin-1') if state else None
+
+    def request_clip(self, from_dt: datetime.datetime, to_dt: datetime.datetime) -> bool:
+        """Marks a clip as queued. Returns False if it is already requested"""
+        return bool(self._redis.set('parklapse.clip.' + self._make_clip_name(from_dt, to_dt), 'queued',
+                                    nx=True, ex=600))
+
+    def provide_timelapse_slots(self) -> list:
+        return [(file, *self._parse_timelapse_to_date_and_slot(file))
+                for file
+                in sorted(glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4'))
+                if os.path.isfile(file)]
+
+    def provide_timelapse_daily(self) -> list:
+        return [(file, self._parse_timelapse_daily_to_date(file))
+                for file
+                in sorted(glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
+                          glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv'))
+                if os.path.isfile(file)]
+
+    @staticmethod
+    def _make_timelapse_video_base(dt: datetime.datetime, slot: int) -> str:
+        return "timelapse-slots-{}_{}".format(dt.strftime('%Y%m%d'),
+                                              slot)
+
+    @staticmethod
+    def _make_timelapse_daily_video_base(dt: datetime.date) -> str:
+        return "timelapse-daily-{}".format(dt.strftime('%Y%m%d'))
+
+    @staticmethod
+    def _make_rollup_key(period: str, date: datetime.date) -> str:
+        """Returns an ISO week like 2019W22 or a month like 201906"""
+        if period == 'weekly':
+            year, week, _ = date.isocalendar()
+            return f'{year}W{week:02d}'
+        return date.strftime('%Y%m')
+
+    @staticmethod
+    def _make_rollup_video_base(period: str, key: str) -> str:
+        return f"timelapse-{period}-{key}"
+
+    def provide_timelapse_rollups(self, period: str) -> list:
+        """Returns rollup files of a period with their keys"""
+        prefix = f'timelapse-{period}-'
+        return [(file, os.path.splitext(os.path.basename(file))[0][len(prefix):])
+                for file
+                in sorted(glob.glob(self.timelapse_path + '/' + prefix + '*.mkv'))
+                if os.path.isfile(file)]
+
+    def get_timelapse_rollup(self, period: str, key: str) -> Optional[str]:
+        file = os.path.join(self.timelapse_path, self._make_rollup_video_base(period, key) + '.mkv')
+        return file if os.path.isfile(file) else None
+
+    def _rollup_days_path(self, rollup_name: str) -> str:
+        return os.path.join(self.timelapse_path, os.path.splitext(rollup_name)[0] + '.days.json')
+
+    def rollup_days(self, rollup_name: str) -> list:
+        """Returns days of a rollup in the order they were added.
+        Redis keeps them for listings, a file next to the rollup recovers them"""
+        days = self._redis.hget('parklapse.rollup.days', self._stream_name(rollup_name))
+        if days:
+            return days.decode('latin-1').split(',')
+        try:
+            with open(self._rollup_days_path(rollup_name), 'rt') as f:
+                return json.load(f)['days']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def decimation_stats(self) -> Optional[dict]:
+        """Returns a share of frames dropped by decimation overall and for the last slot"""
+        frames = {}
+        for name, value in self._redis.hgetall(self.DECIMATION_KEY).items():
+            kept, _, expected = value.decode('latin-1').partition('/')
+            frames[name.decode('latin-1')] = (int(kept), int(expected))
+        if not frames:
+            return None
+        kept_total = sum(kept for kept, _ in frames.values())
+        expected_total = sum(expected for _, expected in frames.values())
+        last_name = max(frames)
+        last_kept, last_expected = frames[last_name]
+        return {
+            'slots': len(frames),
+            'reduction': round(1 - kept_total / expected_total, 3) if expected_total else None,
+            'last_file': last_name,
+            'last_reduction': round(1 - last_kept / last_expected, 3) if last_expected else None,
+        }
+
+    def usage_stats(self) -> Optional[dict]:
+        """Returns usage of each category in MiB and counts of evicted files"""
+        usage = {k: v // (1024 * 1024) for k, v in self._usage.usage().items()}
+        if not usage:
+            return None
+        evicted = self._redis.hgetall('parklapse.retention.evicted')
+        return {
+            'usage_mb': usage,
+            'evicted': {k.decode('latin-1'): int(v) for k, v in evicted.items()},
+        }
+
+
+class StatsService:
+    """Service for collecting statistics in a web-ready JSON using a catalog"""
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def _collect_receivers(self) -> dict:
+        """Health of streams published by a receiver supervisor"""
+        res = {}
+        for name_bytes in sorted(self._redis.smembers('parklapse.supervisor.streams')):
+            name = name_bytes.decode('latin-1')
+            health = self._redis.hgetall('parklapse.supervisor.' + name)
+            res[name] = {k.decode('latin-1'): v.decode('latin-1') for k, v in health.items()}
+        return res
+
+    def collect_stats(self, video_service: Catalog) -> dict:
+        stats = dict()
+        stats['alive'] = True
+        stats['stats_at'] = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+        try:
+            stats['raw_count'] = video_service.raw_count()
+            if video_service.raw_last_at():
+                stats['raw_last_at'] = video_service.raw_last_at().replace(microsecond=0).isoformat()
+            stats['timelapses_daily_count'] = video_service.timelapses_daily_count()
+            stats['timelapses_success_count'] = video_service.timelapses_slots_count()
+            stats['timelapses_error_count'] = video_service.timelapses_error_count()
+            stats['timelapse_last_file'] = video_service.timelapse_last_file()
+            stats['archive_last_file'] = video_service.archive_last_file()
+            stats['archives_count'] = video_service.archives_count()
+            stats['archives_error_count'] = video_service.archives_error_count()
+            if video_service.timelapse_last_at():
+                stats['timelapse_last_at'] = video_service.timelapse_last_at().isoformat()
+            stats["free_disk"] = (shutil.disk_usage(video_service.raw_capture_path).free // (1024 * 1024 * 1024))
+            stats["restarts"] = int(self._redis.get('parklapse.watchdog.restarts') or '0')
+            stats["receivers"] = self._collect_receivers() or None
+            stats["tasks"] = collect_singleton_stats(self._redis) or None
+            stats["jobs"] = video_service.active_jobs() or None
+            stats["archive_peak_rss_mb"] = video_service.archive_peak_rss()
+            stats["encode_profile"] = video_service.profile_stats()
+            stats["placement_mb"] = video_service.placement_stats()
+            stats["storage"] = video_service.usage_stats()
+            stats["decimation"] = video_service.decimation_stats()
+            today = datetime.date.today()
+            stats["gaps_ms"] = {date.strftime('%Y%m%d'): video_service.coverage(date)['missing_ms']
+                                for date in (today - datetime.timedelta(days=1), today)}
+        except Exception as e:
+            logger.error("Exception happens: " + str(e))
+            logger.exception(e)
+            stats['error'] = str(e)
+
+        stats = {k: v for k, v in stats.items() if v is not None}
+        return stats
+
+
+def init_catalog(catalog, config, stream: str = ''):
+    """Configures a catalog of the primary stream or of an extra stream with directories made on demand"""
+    catalog.stream = stream
+    paths = [config['RAW_CAPTURE_PATH'],
+             config['TIMELAPSE_PATH'],
+             config['TMP_PATH'],
+             config['ARCHIVE_PATH'],
+             config['DAMAGED_PATH']]
+    if stream:
+        paths = [catalog._stream_path(path) if path else path for path in paths]
+        for path in paths:
+            if path:
+                os.makedirs(path, exist_ok=True)
+    catalog.init_config(config, *paths)
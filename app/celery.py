@@ -1,8 +1,12 @@
+import socket
+
 from celery import Celery
-from celery.signals import worker_process_init
+from celery.signals import task_postrun, task_prerun, task_revoked, worker_process_init
 from redis import Redis
 
-from app import Config, video_service, init_video_service
+from app import Config, profiler, video_service
+from app.leases import record_dropped_run
+from app.services import init_video_service
 
 # Celery global instance
 celery_app = Celery('parklapse',
@@ -23,6 +27,46 @@ def worker_process_init_handler(**_kwargs):
 
     video_service.init_app(redis)
 
+    profiler.init_config(celery_app.conf)
+
+
+# Sampled runs of tasks being executed by this worker process
+_profile_runs = {}
+
+
+@task_prerun.connect
+def task_prerun_handler(task_id=None, task=None, **_kwargs):
+    """Starts profiling of a sampled task run"""
+    run = profiler.start('task', task.name)
+    if run:
+        _profile_runs[task_id] = run
+
+
+@task_postrun.connect
+def task_postrun_handler(task_id=None, **_kwargs):
+    profiler.finish(_profile_runs.pop(task_id, None))
+
+
+# Revokes are handled by the main worker process, it has no video service
+_revoke_redis = None
+
+
+@task_revoked.connect
+def task_revoked_handler(sender=None, expired=False, **_kwargs):
+    """Counts periodic runs dropped by expiry or revoke, they never reach a singleton lease"""
+    global _revoke_redis
+    import app.tasks
+    name = sender.name.rpartition('.')[2].replace('_task', '')
+    if name not in app.tasks.SINGLETON_TASKS:
+        return
+    try:
+        if _revoke_redis is None:
+            _revoke_redis = Redis.from_url(Config.REDIS_URL)
+        node_name = celery_app.conf.get('NODE_NAME') or socket.gethostname()
+        record_dropped_run(_revoke_redis, app.tasks.singleton_name(name, node_name), expired)
+    except Exception as e:
+        print(f'Cannot record revoked task {name}: {e}')
+
 
 @celery_app.on_after_configure.connect
 def setup_periodic_tasks(sender, **_kwargs):
@@ -31,14 +75,17 @@ def setup_periodic_tasks(sender, **_kwargs):
     # for at least ten seconds because otherwise it will kill it as non-productive
     print('Setup tasks')
     import app.tasks
+    # Periodic runs expire after their interval, so stale enqueues are dropped instead of piling up
     sender.add_periodic_task(60.0, app.tasks.timelapse_task.s(), name='timelapse_task',
-                             queue='slow')
+                             queue='slow', expires=60.0)
     sender.add_periodic_task(300.0, app.tasks.archive_task.s(), name='archive_task',
-                             queue='slow')
+                             queue='slow', expires=300.0)
     sender.add_periodic_task(90.0, app.tasks.watchdog_task.s(), name='watchdog_task',
-                             queue='fast')
+                             queue='fast', expires=90.0)
     sender.add_periodic_task(600.0, app.tasks.cleanup_task.s(), name='cleanup_task',
-                             queue='slow')
+                             queue='slow', expires=600.0)
+    sender.add_periodic_task(60.0, app.tasks.index_task.s(), name='index_task',
+                             queue='fast', expires=60.0)
     sender.add_periodic_task(60.0, app.tasks.receive_task.s(), name='receive_task',
                              queue='inf')
 
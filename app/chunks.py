@@ -0,0 +1,92 @@
+import datetime
+import json
+from typing import Optional
+
+# Chunk metadata is stored per date as a hash: chunk name -> compact json list of FIELDS
+FIELDS = ('start_ms', 'duration_ms', 'frames', 'width', 'height', 'bytes', 'ok')
+
+# Neighbour chunks are treated as continuous if the gap between them is smaller
+GAP_TOLERANCE_MS = 2000
+
+
+def _day_bounds_ms(date: datetime.date) -> (int, int):
+    day_start = datetime.datetime.combine(date, datetime.time())
+    day_end = day_start + datetime.timedelta(days=1)
+    return int(day_start.timestamp() * 1000), int(day_end.timestamp() * 1000)
+
+
+def merge_intervals(intervals: list, tolerance_ms: int = GAP_TOLERANCE_MS) -> list:
+    """Merges [start, end] intervals that overlap or are closer than a tolerance"""
+    res = []
+    for start, end in sorted(intervals):
+        if res and start <= res[-1][1] + tolerance_ms:
+            res[-1][1] = max(res[-1][1], end)
+        else:
+            res.append([start, end])
+    return res
+
+
+class ChunkIndex:
+    """Per-chunk metadata captured once a chunk is closed.
+    It outlives raw files, so coverage is known after archiving"""
+
+    KEY_PREFIX = 'parklapse.chunks.'
+
+    def __init__(self, redis, stream: str = ''):
+        self._redis = redis
+        self._prefix = self.KEY_PREFIX + (stream + '.' if stream else '')
+
+    def _key(self, date: datetime.date) -> str:
+        return self._prefix + date.strftime('%Y%m%d')
+
+    def has(self, date: datetime.date, name: str) -> bool:
+        return bool(self._redis.hexists(self._key(date), name))
+
+    def names(self, date: datetime.date) -> set:
+        return {name.decode('latin-1') for name in self._redis.hkeys(self._key(date))}
+
+    def add(self, date: datetime.date, name: str, meta: dict) -> bool:
+        """Stores metadata of a chunk. Returns False if it was indexed already, by another worker as well"""
+        return bool(self._redis.hsetnx(self._key(date), name, json.dumps([meta[field] for field in FIELDS],
+                                                                         separators=(',', ':'))))
+
+    def for_date(self, date: datetime.date) -> dict:
+        """Returns chunk name -> metadata dict"""
+        return {name.decode('latin-1'): dict(zip(FIELDS, json.loads(value)))
+                for name, value in self._redis.hgetall(self._key(date)).items()}
+
+    def coverage(self, date: datetime.date, now: Optional[datetime.datetime] = None) -> dict:
+        """Returns covered and missing intervals of a day in epoch milliseconds.
+        Intervals of chunks overlapping midnight are clipped. Today is considered until now"""
+        day_start_ms, day_end_ms = _day_bounds_ms(date)
+        now = now or datetime.datetime.now()
+        window_end_ms = min(day_end_ms, int(now.timestamp() * 1000))
+
+        chunks = []
+        for adjacent_date in (date - datetime.timedelta(days=1), date):
+            chunks.extend(self.for_date(adjacent_date).values())
+        covered = merge_intervals([[max(meta['start_ms'], day_start_ms),
+                                    min(meta['start_ms'] + meta['duration_ms'], window_end_ms)]
+                                   for meta in chunks
+                                   if meta['ok'] and
+                                   meta['start_ms'] < window_end_ms and
+                                   meta['start_ms'] + meta['duration_ms'] > day_start_ms])
+
+        missing = []
+        cursor = day_start_ms
+        for start, end in covered:
+            if start > cursor:
+                missing.append([cursor, start])
+            cursor = max(cursor, end)
+        if cursor < window_end_ms:
+            missing.append([cursor, window_end_ms])
+
+        return {
+            'date': date.strftime('%Y%m%d'),
+            'from_ms': day_start_ms,
+            'to_ms': max(day_start_ms, window_end_ms),
+            'covered': covered,
+            'missing': missing,
+            'covered_ms': sum(end - start for start, end in covered),
+            'missing_ms': sum(end - start for start, end in missing),
+        }
@@ -0,0 +1,48 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Modules the web process should not load
+HEAVY_MODULES = ('boto3', 'botocore', 'psutil', 'celery')
+
+_PROBE = """
+import json, resource, sys, time
+started_at = time.perf_counter()
+import {target}
+print(json.dumps({{
+    'seconds': time.perf_counter() - started_at,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy': sorted(m for m in {heavy!r} if m in sys.modules),
+}}))
+"""
+
+
+def measure(target: str) -> dict:
+    """Imports a target module in a fresh interpreter and returns its import time and peak RSS"""
+    res = subprocess.run([sys.executable, '-c', _PROBE.format(target=target, heavy=HEAVY_MODULES)],
+                         stdout=subprocess.PIPE, check=True)
+    return json.loads(res.stdout.decode('latin-1').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the parklapse web process')
+    parser.add_argument('--target', default='start', help='module to import, start creates the web app')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters')
+    args = parser.parse_args()
+
+    runs = [measure(args.target) for _ in range(args.runs)]
+    sys.stdout.write(json.dumps({
+        'target': args.target,
+        'runs': args.runs,
+        'median_seconds': round(statistics.median(run['seconds'] for run in runs), 3),
+        'max_seconds': round(max(run['seconds'] for run in runs), 3),
+        'median_maxrss_mb': round(statistics.median(run['maxrss_kb'] for run in runs) / 1024, 1),
+        'heavy_modules': runs[-1]['heavy'],
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    # Cold start benchmark entry point
+    main()
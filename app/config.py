@@ -11,17 +11,68 @@ class Config(metaclass=MetaFlaskEnv):
     TMP_PATH = None
     DAMAGED_PATH = None
     REDIS_URL = 'redis://localhost:6379'
+    # rate limits are shared by web processes, REDIS_URL is used if not set
+    RATELIMIT_STORAGE_URL = None
     TIMELAPSES_URL_PREFIX = '/'
+    CLIPS_URL_PREFIX = '/clips/'
+    ENABLE_MEDIA = False
+    MEDIA_CLIENT_STREAMS = 4
+    MEDIA_STREAM_TTL = 3600
     CORS_ORIGIN = None
+    API_WORKERS = 8
+    API_TIMEOUT = 3.0
+    API_TIMEOUTS = 'stats:10'
+    API_STALE_SECONDS = 600
+    API_HELLO_TIMEOUT = 10
+    # event streams per web process (keep below WEB_THREADS) and per client within it
+    EVENTS_MAX_STREAMS = 2
+    EVENTS_CLIENT_STREAMS = 1
     READ_ONLY = True
     ENABLE_S3 = False
     BUCKET_NAME = None
     BUCKET_STORAGE_CLASS = 'ONEZONE_IA'
     ARCHIVE_FFMPEG_ADJUSTMENTS = '-c:v libx264 -crf 24 -maxrate 1200K -bufsize 1700K'
     KEEP_ARCHIVE_FILES = 30
+    ENABLE_RETENTION = False
+    RETENTION_BUDGETS = None
+    RETENTION_MAX_AGE_DAYS = None
+    RETENTION_MIN_FREE_BYTES = 20 * 1024 * 1024 * 1024
+    RETENTION_TARGET_FREE_BYTES = 40 * 1024 * 1024 * 1024
+    USAGE_RECONCILE_HOURS = 24
+    # chunks probed by a run of index_task, it shares the fast worker with the watchdog
+    INDEX_BATCH_SIZE = 12
+    CLIPS_PATH = None
+    CLIPS_CACHE_BYTES = 10 * 1024 * 1024 * 1024
+    CLIPS_MAX_MINUTES = 120
+    ENABLE_URGENT_TIMELAPSES = False
+    URGENT_STATE_TTL = 3600
+    ENABLE_PROFILING = False
+    PROFILE_SAMPLE_RATE = 0.01
+    PROFILE_PATH = None
+    PROFILE_MAX_FILES = 200
     ENABLE_WATCHDOG_PROCESS = False
     ENABLE_WATCHDOG_CELERY = False
     RTSP_SOURCE = None
+    RTSP_SOURCES = None
+    SUPERVISOR_BACKOFF_BASE = 1.0
+    SUPERVISOR_BACKOFF_MAX = 30.0
+    SUPERVISOR_STABLE_UPTIME = 60
     UMASK = 0
     ENABLE_ARCHIVE_COMPRESSION = True
+    ENABLE_COMBINED_ENCODE = False
+    ENABLE_RESUMABLE_ENCODE = False
+    ENABLE_DECIMATION = False
+    DECIMATION_MAX_DROP = 8
+    ENABLE_ROLLUPS = False
+    ROLLUP_FRAME_STEPS = 'weekly:1,monthly:4'
+    ENABLE_ADAPTIVE_PROFILES = False
+    TIMELAPSE_PROFILE_LADDER = 'slow:21,medium:22,fast:23,veryfast:25,ultrafast:27'
+    ARCHIVE_PROFILE_LADDER = 'medium:24,fast:25,faster:26,veryfast:27,ultrafast:28'
+    PROFILE_BACKLOG_LOW = 3
+    PROFILE_BACKLOG_HIGH = 24
+    PROFILE_CATCHUP_HOURS = 12
     MAX_DRIFT = 12
+    SINGLETON_LEASE_TTL = 300
+    JOB_LEASE_TTL = 120
+    NODE_NAME = None
+    JOBS_HISTORY_SIZE = 5000
@@ -0,0 +1,112 @@
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+
+import werkzeug.exceptions
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'parklapse.events'
+
+TIMELAPSE_SLOT = 'timelapse.slot'
+TIMELAPSE_DAILY = 'timelapse.daily'
+TIMELAPSE_ROLLUP = 'timelapse.rollup'
+ARCHIVE_DONE = 'archive.done'
+CHUNK_CLOSED = 'chunk.closed'
+WATCHDOG_RESTART = 'watchdog.restart'
+EVENT_TYPES = (TIMELAPSE_SLOT, TIMELAPSE_DAILY, TIMELAPSE_ROLLUP, ARCHIVE_DONE, CHUNK_CLOSED, WATCHDOG_RESTART)
+
+
+def publish(redis, event_type: str, **payload):
+    """Publishes a typed event to the channel. Producers never fail because of events"""
+    if event_type not in EVENT_TYPES:
+        raise ValueError('Unknown event type ' + event_type)
+    event = dict(payload, type=event_type,
+                 at=datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat())
+    try:
+        redis.publish(CHANNEL, json.dumps(event, separators=(',', ':')))
+    except Exception as e:
+        logger.error(f"Cannot publish event {event_type}: {e}")
+
+
+class EventHub:
+    """Fans out events from a single Redis subscription to local listeners and subscriber queues.
+    Slow subscribers lose their oldest events instead of blocking others.
+
+    Every subscriber holds a server thread, so their number is limited per process and per client"""
+
+    QUEUE_SIZE = 100
+    RECONNECT_DELAY = 5
+
+    def __init__(self):
+        self._redis = None
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._listeners = []
+        self._thread = None
+        self._max_streams = 0
+        self._client_streams = 0
+
+    def init_app(self, redis, max_streams: int = 0, client_streams: int = 0):
+        self._redis = redis
+        self._max_streams = max_streams
+        self._client_streams = client_streams
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        """Starts a subscription thread once per process"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='events', daemon=True)
+                self._thread.start()
+
+    def subscribe(self, client: str = '') -> queue.Queue:
+        """Returns a queue of events. Raises 503 if a process has no threads to spare, 429 if a client has enough"""
+        self.start()
+        events = queue.Queue(maxsize=self.QUEUE_SIZE)
+        with self._lock:
+            if self._max_streams and len(self._queues) >= self._max_streams:
+                raise werkzeug.exceptions.ServiceUnavailable("Too many event streams, try again later")
+            if self._client_streams and \
+                    sum(1 for c in self._queues.values() if c == client) >= self._client_streams:
+                raise werkzeug.exceptions.TooManyRequests("Too many event streams of a client")
+            self._queues[events] = client
+        return events
+
+    def unsubscribe(self, events: queue.Queue):
+        with self._lock:
+            self._queues.pop(events, None)
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    self._dispatch(json.loads(message['data']))
+            except Exception as e:
+                logger.error(f"Event subscription failed: {e}")
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _dispatch(self, event: dict):
+        for callback in self._listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Event listener failed: {e}")
+        with self._lock:
+            subscribers = list(self._queues)
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+                events.put_nowait(event)
@@ -0,0 +1,94 @@
+import argparse
+import datetime
+import json
+import sys
+
+from app.procs import ProcResult
+
+
+class JobHistory:
+    """Rolling history of resources used by child processes, stored in a capped Redis list"""
+
+    KEY = 'parklapse.jobs.history'
+
+    def __init__(self, redis, max_size: int = 5000):
+        self._redis = redis
+        self._max_size = int(max_size)
+
+    def record(self, stage: str, tool: str, res: ProcResult, labels: dict):
+        entry = dict(labels)
+        entry.update({
+            'stage': stage,
+            'tool': tool,
+            'at': datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat(),
+            'returncode': res.returncode,
+            'wall': round(res.wall, 3),
+            'utime': round(res.utime, 3),
+            'stime': round(res.stime, 3),
+            'maxrss_kb': res.maxrss,
+            'read_bytes': res.read_bytes,
+            'write_bytes': res.write_bytes,
+        })
+        pipe = self._redis.pipeline()
+        pipe.lpush(self.KEY, json.dumps(entry, separators=(',', ':')))
+        pipe.ltrim(self.KEY, 0, self._max_size - 1)
+        pipe.execute()
+
+    def recent(self, limit: int = 100) -> list:
+        return [json.loads(item) for item in self._redis.lrange(self.KEY, 0, limit - 1)]
+
+
+def summarize(entries: list) -> dict:
+    """Sums costs per job kind and stage. Footage of each job is counted once per stage"""
+    # footage becomes known in the middle of a job, so take it from any entry of the job
+    jobs_footage = {}
+    for entry in entries:
+        if entry.get('job_id') and entry.get('footage_s'):
+            jobs_footage[entry['job_id']] = entry['footage_s']
+
+    groups = {}
+    for entry in entries:
+        group = groups.setdefault(f"{entry.get('job', 'none')}.{entry['stage']}", {
+            'runs': 0, 'failures': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_mb': 0,
+            'read_bytes': 0, 'write_bytes': 0, '_footage': {}})
+        group['runs'] += 1
+        group['failures'] += 1 if entry['returncode'] != 0 else 0
+        group['wall'] += entry['wall']
+        group['cpu'] += entry['utime'] + entry['stime']
+        group['max_rss_mb'] = max(group['max_rss_mb'], entry['maxrss_kb'] // 1024)
+        group['read_bytes'] += entry['read_bytes']
+        group['write_bytes'] += entry['write_bytes']
+        if entry.get('job_id') in jobs_footage:
+            group['_footage'][entry['job_id']] = jobs_footage[entry['job_id']]
+
+    for group in groups.values():
+        footage_hours = sum(group.pop('_footage').values()) / 3600
+        group['footage_hours'] = round(footage_hours, 2)
+        group['wall'] = round(group['wall'], 1)
+        group['cpu'] = round(group['cpu'], 1)
+        group['wall_per_footage_hour'] = round(group['wall'] / footage_hours, 1) if footage_hours else None
+        group['cpu_per_footage_hour'] = round(group['cpu'] / footage_hours, 1) if footage_hours else None
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary of resources used by parklapse jobs')
+    parser.add_argument('--limit', type=int, default=5000, help='number of recent child processes')
+    args = parser.parse_args()
+
+    from redis import Redis
+    from app.config import Config
+
+    summary = summarize(JobHistory(Redis.from_url(Config.REDIS_URL)).recent(args.limit))
+    columns = ['runs', 'failures', 'footage_hours', 'wall', 'cpu',
+               'wall_per_footage_hour', 'cpu_per_footage_hour', 'max_rss_mb']
+    sys.stdout.write('{:<24}'.format('stage') + ''.join('{:>22}'.format(c) for c in columns) + '\n')
+    for name, group in sorted(summary.items()):
+        sys.stdout.write('{:<24}'.format(name) +
+                         ''.join('{:>22}'.format('-' if group[c] is None else str(group[c])) for c in columns) +
+                         '\n')
+
+
+if __name__ == '__main__':
+    # Jobs summary entry point
+    main()
@@ -0,0 +1,120 @@
+import logging
+import threading
+import uuid
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Lua scripts make sure that only the lease owner prolongs or releases it
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease:
+    """Redis-based lease with an expiration.
+
+    A lease is owned by a random token, so an expired and re-acquired lease
+    cannot be renewed or released by a previous owner.
+    While used as a context manager, the lease is renewed from a background thread."""
+
+    def __init__(self, redis, key: str, ttl: float, owner: str = ''):
+        self._redis = redis
+        self.key = key
+        self.ttl = float(ttl)
+        self.token = f'{owner}:{uuid.uuid4().hex}'
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def _ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+    def acquire(self) -> bool:
+        return bool(self._redis.set(self.key, self.token, nx=True, px=self._ttl_ms))
+
+    def renew(self) -> bool:
+        return bool(self._redis.eval(_RENEW_SCRIPT, 1, self.key, self.token, self._ttl_ms))
+
+    def release(self) -> bool:
+        return bool(self._redis.eval(_RELEASE_SCRIPT, 1, self.key, self.token))
+
+    def _heartbeat(self):
+        while not self._stop_event.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    logger.warning(f"Lease {self.key} is lost")
+                    return
+            except Exception as e:
+                logger.error(f"Cannot renew lease {self.key}: {e}")
+
+    def __enter__(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._heartbeat, name='lease-' + self.key, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_event.set()
+        self._thread.join()
+        try:
+            self.release()
+        except Exception as e:
+            logger.error(f"Cannot release lease {self.key}: {e}")
+
+
+SINGLETON_STATS_KEY = 'parklapse.singleton.stats'
+
+
+def run_singleton(redis, name: str, ttl: float, func: Callable[[], None]) -> bool:
+    """Runs func if no other instance of the named periodic task is running.
+
+    Otherwise the call is coalesced into a 'run again when done' flag checked by the running instance,
+    or skipped completely if the flag is already set.
+    Returns True if func was called."""
+    key = 'parklapse.singleton.' + name
+    rerun_key = key + '.rerun'
+    lease = Lease(redis, key, ttl)
+    if not lease.acquire():
+        if redis.set(rerun_key, 1, nx=True):
+            logger.info(f"Task {name} is already running, coalesced into a rerun")
+            redis.hincrby(SINGLETON_STATS_KEY, name + '.coalesced', 1)
+        else:
+            logger.info(f"Task {name} is already running with a rerun pending, skipped")
+            redis.hincrby(SINGLETON_STATS_KEY, name + '.skipped', 1)
+        return False
+
+    with lease:
+        redis.delete(rerun_key)
+        while True:
+            redis.hincrby(SINGLETON_STATS_KEY, name + '.runs', 1)
+            func()
+            if not redis.delete(rerun_key):
+                break
+            logger.info(f"Task {name} was requested while running, run again")
+    return True
+
+
+def record_dropped_run(redis, name: str, expired: bool):
+    """Counts a periodic run dropped by a worker before it reached the lease.
+    With one worker per node runs rarely overlap, expiry is what actually drops them"""
+    redis.hincrby(SINGLETON_STATS_KEY, name + ('.expired' if expired else '.revoked'), 1)
+
+
+def collect_singleton_stats(redis) -> dict:
+    """Returns run, skip, coalesce, expiry and revoke counters grouped by task name"""
+    res = {}
+    for field, value in redis.hgetall(SINGLETON_STATS_KEY).items():
+        name, _, counter = field.decode('latin-1').rpartition('.')
+        res.setdefault(name, {})[counter] = int(value)
+    return res
@@ -0,0 +1,148 @@
+import datetime
+import os
+import time
+import uuid
+from typing import Optional
+
+import werkzeug.exceptions
+import werkzeug.http
+from flask import current_app, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
+
+MIMETYPES = {'.mp4': 'video/mp4', '.mkv': 'video/x-matroska'}
+
+# Named outputs never change, rollups are rewritten under the same name and must be revalidated
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'public, no-cache'
+
+
+class _FileRange:
+    """Slice of an open file for a WSGI file wrapper.
+    Servers using sendfile take its descriptor, position and Content-Length, others read it"""
+
+    def __init__(self, f, start: int, length: int, on_close=None):
+        f.seek(start)
+        self._f = f
+        self._left = length
+        self._on_close = on_close
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+
+def _etag(st: os.stat_result) -> str:
+    """Strong validator, a file is never rewritten under the same inode, size and mtime"""
+    return '{:x}-{:x}-{:x}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def file_response(path: str, immutable: bool = True, on_close=None):
+    """Makes a response for a whole file or a single byte range of it.
+    Conditional requests are answered with 304, an unsatisfiable range with 416,
+    multiple ranges are ignored and the whole file is sent.
+    on_close is called once a body is sent or right away if there is none"""
+    f = None
+    body = None
+    try:
+        f = open(path, 'rb')
+        st = os.fstat(f.fileno())
+        etag = _etag(st)
+        last_modified = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+        response = current_app.response_class(
+            mimetype=MIMETYPES.get(os.path.splitext(path)[1], 'application/octet-stream'))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        if not werkzeug.http.is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response.status_code = 304
+            return response
+
+        start, stop = 0, st.st_size
+        # a range of a changed file is useless to a client, If-Range asks for the whole file then
+        single_range = request.range and len(request.range.ranges) == 1
+        if single_range and ('If-Range' not in request.headers or
+                             not werkzeug.http.is_resource_modified(request.environ, etag=etag,
+                                                                    last_modified=last_modified,
+                                                                    ignore_if_range=False)):
+            byte_range = request.range.range_for_length(st.st_size)
+            if byte_range is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = f'bytes */{st.st_size}'
+                return response
+            start, stop = byte_range
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, stop, st.st_size)
+
+        response.content_length = stop - start
+        if request.method != 'HEAD':
+            # a server closes the wrapper after sending, the wrapper closes the file
+            body = _FileRange(f, start, stop - start, on_close)
+            response.response = wrap_file(request.environ, body)
+            response.direct_passthrough = True
+        return response
+    finally:
+        if body is None:
+            if f:
+                f.close()
+            if on_close:
+                on_close()
+
+
+class StreamLimiter:
+    """Limits concurrent media streams of a client across web processes.
+    Streams are tracked in a Redis sorted set per client, ones of crashed processes expire"""
+
+    def __init__(self):
+        self._redis = None
+        self._max_streams = 0
+        self._ttl = 3600.0
+
+    def init_app(self, app, redis):
+        self._redis = redis
+        self._max_streams = int(app.config['MEDIA_CLIENT_STREAMS'])
+        self._ttl = float(app.config['MEDIA_STREAM_TTL'])
+
+    @staticmethod
+    def _key(client: str) -> str:
+        return 'parklapse.media.streams.' + client
+
+    def acquire(self, client: str) -> Optional[str]:
+        """Registers a stream of a client. Returns its token or None if the client has too many"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.zremrangebyscore(self._key(client), '-inf', now - self._ttl)
+        pipe.zadd(self._key(client), {token: now})
+        pipe.zcard(self._key(client))
+        pipe.expire(self._key(client), int(self._ttl))
+        streams = pipe.execute()[2]
+        if streams > self._max_streams:
+            self._redis.zrem(self._key(client), token)
+            return None
+        return token
+
+    def release(self, client: str, token: str):
+        self._redis.zrem(self._key(client), token)
+
+    def serve(self, path: str, immutable: bool = True):
+        """Makes a file response holding a stream slot of a client until it is sent"""
+        client = request.remote_addr or 'unknown'
+        token = self.acquire(client)
+        if not token:
+            raise werkzeug.exceptions.TooManyRequests("Too many concurrent streams")
+        return file_response(path, immutable, on_close=lambda: self.release(client, token))
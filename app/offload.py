@@ -0,0 +1,81 @@
+import collections
+import concurrent.futures
+import threading
+import time
+from typing import Optional
+
+import werkzeug.exceptions
+
+
+def parse_timeouts(timeouts: Optional[str]) -> dict:
+    """Parses per-endpoint timeouts 'stats:10,timelapses:3'"""
+    res = {}
+    for item in (timeouts or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        endpoint, sep, seconds = item.partition(':')
+        if not sep:
+            raise RuntimeError('Bad endpoint timeout ' + item)
+        res[endpoint.strip()] = float(seconds)
+    return res
+
+
+class Offloader:
+    """Runs filesystem and Redis work of API endpoints on a thread pool.
+
+    A request waits for its result up to an endpoint timeout, concurrent requests for the same key
+    share one call. If a call is slow, the last result not older than API_STALE_SECONDS is served,
+    so a slow disk delays fresh data instead of stalling request threads."""
+
+    MAX_RESULTS = 1024
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.RLock()
+        self._inflight = {}
+        self._results = collections.OrderedDict()
+        self._default_timeout = 3.0
+        self._timeouts = {}
+        self._max_stale = 600.0
+
+    def init_app(self, app):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(app.config['API_WORKERS']),
+                                                               thread_name_prefix='api')
+        self._default_timeout = float(app.config['API_TIMEOUT'])
+        self._timeouts = parse_timeouts(app.config['API_TIMEOUTS'])
+        self._max_stale = float(app.config['API_STALE_SECONDS'])
+
+    def call(self, endpoint: str, key: tuple, func) -> (object, Optional[float]):
+        """Returns a result of func and None, or a stale result and its age in seconds"""
+        key = (endpoint,) + key
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(func)
+                self._inflight[key] = future
+                future.add_done_callback(lambda f: self._done(key, f))
+        try:
+            return future.result(timeout=self._timeouts.get(endpoint, self._default_timeout)), None
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                cached = self._results.get(key)
+            if cached and time.monotonic() - cached[0] <= self._max_stale:
+                return cached[1], time.monotonic() - cached[0]
+            raise werkzeug.exceptions.ServiceUnavailable("Storage is slow, try again later")
+
+    def _done(self, key: tuple, future: concurrent.futures.Future):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._results[key] = (time.monotonic(), future.result())
+            self._results.move_to_end(key)
+            while len(self._results) > self.MAX_RESULTS:
+                self._results.popitem(last=False)
+
+    def invalidate(self, *endpoints: str):
+        """Drops results of endpoints, so no stale data is served after a change"""
+        with self._lock:
+            for key in [key for key in self._results if key[0] in endpoints]:
+                del self._results[key]
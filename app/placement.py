@@ -0,0 +1,120 @@
+import errno
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# Copy in large pieces, kernel-side copy does not need user-space buffers
+_COPY_CHUNK = 64 * 1024 * 1024
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, size: int) -> str:
+    """Copies file contents without passing them through user space if possible"""
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range:
+        try:
+            offset = 0
+            while offset < size:
+                copied = copy_file_range(src_fd, dst_fd, min(_COPY_CHUNK, size - offset))
+                if copied == 0:
+                    break
+                offset += copied
+            return 'copy_file_range'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            # start over using sendfile
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+
+    try:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst_fd, src_fd, offset, min(_COPY_CHUNK, size - offset))
+            if sent == 0:
+                break
+            offset += sent
+        return 'sendfile'
+    except OSError as e:
+        if e.errno not in (errno.ENOSYS, errno.EINVAL):
+            raise
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+        os.ftruncate(dst_fd, 0)
+
+    with open(src_fd, 'rb', closefd=False) as src, open(dst_fd, 'wb', closefd=False) as dst:
+        shutil.copyfileobj(src, dst, _COPY_CHUNK)
+    return 'copy'
+
+
+class FilePlacer:
+    """Places finished files to their directories.
+
+    Files are renamed when both paths are on the same filesystem.
+    Otherwise contents are copied by the kernel to a hidden file next to the target,
+    which is synced and renamed over the target before the source is removed.
+    Bytes moved by each strategy are counted in redis."""
+
+    STATS_KEY = 'parklapse.placement.bytes'
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def place(self, src: str, dst: str) -> str:
+        """Moves or copies src to dst path or into dst directory. Returns a strategy used"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        size = os.path.getsize(src)
+
+        strategy = None
+        try:
+            os.replace(src, dst)
+            strategy = 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        if not strategy:
+            strategy = self._copy(src, dst)
+            os.remove(src)
+
+        logger.info(f"Placed {src} to {dst} by {strategy}, {size // (1024 * 1024)} MiB")
+        try:
+            self._redis.hincrby(self.STATS_KEY, strategy, size)
+        except Exception as e:
+            logger.error(f"Cannot record placement stats: {e}")
+        return strategy
+
+    @staticmethod
+    def _hidden_path(dst: str) -> str:
+        return os.path.join(os.path.dirname(dst), '.placing-' + os.path.basename(dst))
+
+    def _copy(self, src: str, dst: str) -> str:
+        tmp_dst = self._hidden_path(dst)
+        try:
+            with open(src, 'rb') as src_f, open(tmp_dst, 'wb') as dst_f:
+                strategy = _kernel_copy(src_f.fileno(), dst_f.fileno(), os.fstat(src_f.fileno()).st_size)
+                dst_f.flush()
+                os.fsync(dst_f.fileno())
+            shutil.copystat(src, tmp_dst)
+            # data must be durable before the target name appears and the source disappears
+            os.replace(tmp_dst, dst)
+            _fsync_dir(os.path.dirname(dst) or '.')
+        except Exception:
+            if os.path.lexists(tmp_dst):
+                os.remove(tmp_dst)
+            raise
+        return strategy
+
+    def stats(self) -> dict:
+        return {k.decode('latin-1'): int(v) for k, v in self._redis.hgetall(self.STATS_KEY).items()}
@@ -0,0 +1,69 @@
+import collections
+import logging
+import os
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ProcResult = collections.namedtuple('ProcResult', ['returncode', 'stdout', 'stderr', 'wall', 'utime', 'stime',
+                                                   'maxrss', 'read_bytes', 'write_bytes'])
+ProcResult.__doc__ = """Result of a child process. Times are in seconds, maxrss is a peak RSS in KiB.
+Read and written bytes are block device I/O reported by rusage"""
+
+# rusage block counters are in 512-byte units
+_BLOCK_SIZE = 512
+
+
+def _status_to_returncode(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _read_lines(stream, on_line):
+    for line in stream:
+        try:
+            on_line(line.decode('latin-1').rstrip('\n'))
+        except Exception as e:
+            logger.error(f"Cannot handle output line: {e}")
+
+
+def run_command(command: list, capture_stdout: bool = False, on_stdout_line=None) -> ProcResult:
+    """Runs a command like subprocess.run with captured stderr.
+    Stdout is either captured or passed line by line to on_stdout_line as the child writes it.
+    The child is reaped with wait4 to get its own resource usage"""
+    start_time = time.perf_counter()
+    proc = subprocess.Popen(command, shell=False,
+                            stdout=subprocess.PIPE if capture_stdout or on_stdout_line else None,
+                            stderr=subprocess.PIPE)
+    stdout = None
+    reader = None
+    if on_stdout_line:
+        reader = threading.Thread(target=_read_lines, args=(proc.stdout, on_stdout_line), daemon=True)
+        reader.start()
+    elif capture_stdout:
+        # drain stdout concurrently so the child never blocks on a full pipe
+        stdout_chunks = []
+        reader = threading.Thread(target=lambda: stdout_chunks.append(proc.stdout.read()), daemon=True)
+        reader.start()
+    with proc.stderr:
+        stderr = proc.stderr.read()
+    if reader:
+        reader.join()
+        proc.stdout.close()
+        if not on_stdout_line:
+            stdout = stdout_chunks[0]
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # let Popen know that the child is already reaped
+    proc.returncode = _status_to_returncode(status)
+    return ProcResult(returncode=proc.returncode,
+                      stdout=stdout,
+                      stderr=stderr,
+                      wall=time.perf_counter() - start_time,
+                      utime=rusage.ru_utime,
+                      stime=rusage.ru_stime,
+                      maxrss=rusage.ru_maxrss,
+                      read_bytes=rusage.ru_inblock * _BLOCK_SIZE,
+                      write_bytes=rusage.ru_oublock * _BLOCK_SIZE)
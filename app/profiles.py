@@ -0,0 +1,123 @@
+import collections
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+EncodeProfile = collections.namedtuple('EncodeProfile', ['preset', 'crf'])
+
+
+def parse_ladder(ladder: str) -> list:
+    """Parses a ladder 'slow:20,medium:22,veryfast:26' ordered from the best quality to the fastest"""
+    res = []
+    for item in (ladder or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        preset, sep, crf = item.partition(':')
+        if not sep:
+            raise RuntimeError('Bad profile ladder item ' + item)
+        res.append(EncodeProfile(preset.strip(), int(crf)))
+    if not res:
+        raise RuntimeError('Empty profile ladder')
+    return res
+
+
+def format_profile(profile: EncodeProfile) -> str:
+    return f'{profile.preset}:{profile.crf}'
+
+
+class ProfileController:
+    """Chooses x264 presets depending on a backlog and a measured encode speed.
+
+    A single ladder level is shared by timelapse and archive ladders.
+    The level moves one step towards faster presets while the backlog cannot be caught up
+    in PROFILE_CATCHUP_HOURS or exceeds PROFILE_BACKLOG_HIGH footage hours,
+    and one step back to better quality when the backlog drops to PROFILE_BACKLOG_LOW."""
+
+    LEVEL_KEY = 'parklapse.profile.level'
+    SPEED_KEY = 'parklapse.profile.speed'
+    BACKLOG_KEY = 'parklapse.profile.backlog'
+    USED_KEY = 'parklapse.profile.used'
+    SPEED_ALPHA = 0.3
+
+    def __init__(self, redis, config):
+        self._redis = redis
+        self._ladders = {'timelapse': parse_ladder(config['TIMELAPSE_PROFILE_LADDER']),
+                         'archive': parse_ladder(config['ARCHIVE_PROFILE_LADDER'])}
+        self._max_level = min(len(ladder) for ladder in self._ladders.values()) - 1
+        self._backlog_low = float(config['PROFILE_BACKLOG_LOW'])
+        self._backlog_high = float(config['PROFILE_BACKLOG_HIGH'])
+        self._catchup_hours = float(config['PROFILE_CATCHUP_HOURS'])
+
+    def set_backlog(self, kind: str, footage_hours: float):
+        self._redis.hset(self.BACKLOG_KEY, kind, footage_hours)
+
+    def consume_backlog(self, kind: str, footage_hours: float):
+        """Lowers a backlog as outputs are produced between backlog scans"""
+        if float(self._redis.hincrbyfloat(self.BACKLOG_KEY, kind, -footage_hours)) < 0:
+            self._redis.hset(self.BACKLOG_KEY, kind, 0)
+
+    def record_speed(self, kind: str, footage_seconds: float, wall_seconds: float):
+        """Keeps an exponential moving average of footage seconds encoded per wall second"""
+        if wall_seconds <= 0 or footage_seconds <= 0:
+            return
+        ratio = footage_seconds / wall_seconds
+        prev = self._redis.hget(self.SPEED_KEY, kind)
+        if prev is not None:
+            ratio = self.SPEED_ALPHA * ratio + (1 - self.SPEED_ALPHA) * float(prev)
+        self._redis.hset(self.SPEED_KEY, kind, round(ratio, 3))
+
+    def _backlog_hours(self) -> float:
+        return sum(float(v) for v in self._redis.hvals(self.BACKLOG_KEY))
+
+    def _effective_speed(self) -> Optional[float]:
+        """Speed of the whole pipeline when every footage hour passes through all measured encoders"""
+        speeds = [float(v) for v in self._redis.hvals(self.SPEED_KEY)]
+        if not speeds or min(speeds) <= 0:
+            return None
+        return 1 / sum(1 / speed for speed in speeds)
+
+    def _decide_level(self) -> int:
+        level = int(self._redis.get(self.LEVEL_KEY) or 0)
+        backlog = self._backlog_hours()
+        speed = self._effective_speed()
+        if backlog <= self._backlog_low:
+            new_level = max(0, level - 1)
+        else:
+            behind = backlog > self._backlog_high
+            if speed is not None:
+                # footage keeps arriving in real time while the backlog is processed
+                behind = behind or speed <= 1 or backlog / (speed - 1) > self._catchup_hours
+            new_level = min(self._max_level, level + 1) if behind else level
+        new_level = min(new_level, self._max_level)
+        if new_level != level:
+            logger.info(f"Encode profile level {level} -> {new_level}, backlog {backlog} hours, speed {speed}")
+            self._redis.set(self.LEVEL_KEY, new_level)
+        return new_level
+
+    def choose(self, kind: str) -> EncodeProfile:
+        return self._ladders[kind][self._decide_level()]
+
+    def record_used(self, output_name: str, profile: EncodeProfile):
+        self._redis.hset(self.USED_KEY, output_name, format_profile(profile))
+
+    def forget_used(self, output_name: str):
+        self._redis.hdel(self.USED_KEY, output_name)
+
+    def trim_used(self, existing_names: set):
+        """Drops profiles of outputs that are gone. Returns a number of dropped ones"""
+        gone = [name for name in self._redis.hkeys(self.USED_KEY) if name.decode('latin-1') not in existing_names]
+        if gone:
+            self._redis.hdel(self.USED_KEY, *gone)
+        return len(gone)
+
+    def stats(self) -> dict:
+        level = int(self._redis.get(self.LEVEL_KEY) or 0)
+        return {
+            'level': level,
+            'timelapse': format_profile(self._ladders['timelapse'][min(level, self._max_level)]),
+            'archive': format_profile(self._ladders['archive'][min(level, self._max_level)]),
+            'backlog_hours': self._backlog_hours(),
+            'speed': {k.decode('latin-1'): float(v) for k, v in self._redis.hgetall(self.SPEED_KEY).items()},
+        }
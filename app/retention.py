@@ -0,0 +1,136 @@
+import collections
+import os
+from typing import Optional
+
+CATEGORIES = ('raw', 'timelapse', 'damaged', 'tmp', 'archive', 'clips')
+
+# Categories that may be evicted, in order of least valuable first
+EVICTION_ORDER = ('tmp', 'damaged', 'timelapse')
+
+Candidate = collections.namedtuple('Candidate', ['category', 'path', 'size', 'mtime', 'dev'])
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value) -> int:
+    """Parses a byte size like 1073741824, '500M' or '20G'"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in _SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+def parse_limits(limits: Optional[str], parse_value) -> dict:
+    """Parses per-category limits 'tmp:50G,damaged:10G'"""
+    res = {}
+    for item in (limits or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        category, sep, value = item.partition(':')
+        category = category.strip()
+        if not sep or category not in EVICTION_ORDER:
+            raise RuntimeError('Bad retention limit ' + item)
+        res[category] = parse_value(value.strip())
+    return res
+
+
+def sum_sizes(files: list) -> int:
+    """Sums sizes of files skipping ones that disappeared meanwhile"""
+    total = 0
+    for file in files:
+        try:
+            total += os.stat(file).st_size
+        except OSError:
+            pass
+    return total
+
+
+class UsageLedger:
+    """Bytes used by each category of files, kept up to date on every create and delete.
+    A periodic reconcile replaces the totals with a scan to repair drift"""
+
+    KEY = 'parklapse.usage'
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def add(self, category: str, nbytes: int):
+        if category and nbytes:
+            self._redis.hincrby(self.KEY, category, int(nbytes))
+
+    def reset(self, usage: dict):
+        pipe = self._redis.pipeline()
+        for category, nbytes in usage.items():
+            pipe.hset(self.KEY, category, int(nbytes))
+        pipe.execute()
+
+    def usage(self) -> dict:
+        return {k.decode('latin-1'): max(0, int(v)) for k, v in self._redis.hgetall(self.KEY).items()}
+
+    def drifted(self) -> bool:
+        """Checks if totals are missing or went negative, so they must be scanned again"""
+        totals = self._redis.hgetall(self.KEY)
+        return not totals or any(int(v) < 0 for v in totals.values())
+
+
+class RetentionPolicy:
+    """Decides which files to evict.
+
+    A file is evicted when it is older than a category age limit, when a category exceeds its
+    byte budget (oldest first), or, when free space drops below RETENTION_MIN_FREE_BYTES,
+    in EVICTION_ORDER until RETENTION_TARGET_FREE_BYTES is free on the watched filesystem."""
+
+    def __init__(self, config):
+        self._budgets = parse_limits(config['RETENTION_BUDGETS'], parse_size)
+        self._max_ages = parse_limits(config['RETENTION_MAX_AGE_DAYS'], lambda days: float(days) * 86400)
+        self._min_free = parse_size(config['RETENTION_MIN_FREE_BYTES'])
+        self._target_free = max(self._min_free, parse_size(config['RETENTION_TARGET_FREE_BYTES']))
+
+    def categories_to_scan(self, usage: dict, free_bytes: int, check_ages: bool) -> list:
+        """Returns categories that may have files to evict by counted usage, others need no listing"""
+        categories = set(self._max_ages) if check_ages else set()
+        categories.update(category for category, budget in self._budgets.items() if usage.get(category, 0) > budget)
+        if free_bytes < self._min_free:
+            categories.update(EVICTION_ORDER)
+        return [category for category in EVICTION_ORDER if category in categories]
+
+    def plan(self, candidates: list, usage: dict, free_bytes: int, watched_dev: int, now: float) -> list:
+        """Returns candidates to evict. Only files on the watched device free its space"""
+        evict = {}
+        usage = dict(usage)
+
+        def take(candidate, reason):
+            nonlocal free_bytes
+            if candidate.path in evict:
+                return
+            evict[candidate.path] = (candidate, reason)
+            usage[candidate.category] = usage.get(candidate.category, 0) - candidate.size
+            if candidate.dev == watched_dev:
+                free_bytes += candidate.size
+
+        by_category = {category: sorted([c for c in candidates if c.category == category],
+                                        key=lambda c: c.mtime)
+                       for category in EVICTION_ORDER}
+
+        for category, max_age in self._max_ages.items():
+            for candidate in by_category[category]:
+                if now - candidate.mtime > max_age:
+                    take(candidate, 'age')
+
+        for category, budget in self._budgets.items():
+            for candidate in by_category[category]:
+                if usage.get(category, 0) <= budget:
+                    break
+                take(candidate, 'budget')
+
+        if free_bytes < self._min_free:
+            for category in EVICTION_ORDER:
+                for candidate in by_category[category]:
+                    if free_bytes >= self._target_free:
+                        break
+                    if candidate.dev == watched_dev:
+                        take(candidate, 'watermark')
+
+        return list(evict.values())
@@ -0,0 +1,120 @@
+import cProfile
+import datetime
+import glob
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRun:
+    """Profiles of one sampled run. Work handed to other threads is profiled there and added on return"""
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._main = self._enable()
+
+    def _enable(self) -> cProfile.Profile:
+        # cProfile hooks only the calling thread
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def follow(self, func):
+        """Wraps a function to profile it in a thread that runs it"""
+        def wrapper(*args, **kwargs):
+            profile = self._enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+        return wrapper
+
+    def stop(self) -> pstats.Stats:
+        """Stops profiling. Must be called from a thread that started the run"""
+        self._main.disable()
+        with self._lock:
+            return pstats.Stats(self._main, *self._profiles)
+
+
+class SamplingProfiler:
+    """Profiles a random share of celery task runs and API requests with cProfile.
+
+    Results are pstats files in PROFILE_PATH, the oldest ones are removed above PROFILE_MAX_FILES.
+    Open them with `python -m pstats <file>` or snakeviz."""
+
+    def __init__(self):
+        self.path = None
+        self._rate = 0.0
+        self._max_files = 0
+
+    def init_config(self, config):
+        self._rate = float(config['PROFILE_SAMPLE_RATE']) if config['ENABLE_PROFILING'] else 0.0
+        self._max_files = int(config['PROFILE_MAX_FILES'])
+        self.path = config['PROFILE_PATH'] or os.path.join(config['TMP_PATH'], 'profiles')
+
+    @property
+    def enabled(self) -> bool:
+        return self._rate > 0
+
+    def start(self, kind: str, name: str) -> Optional[ProfileRun]:
+        """Starts profiling of a run if it is sampled"""
+        if not self.enabled or random.random() >= self._rate:
+            return None
+        return ProfileRun(kind, name)
+
+    def finish(self, run: Optional[ProfileRun]):
+        """Stops a run and writes its profile. Profiling never fails a profiled run"""
+        if not run:
+            return
+        try:
+            stats = run.stop()
+            elapsed_ms = (time.monotonic() - run.started_at) * 1000
+            name = re.sub(r'[^\w.]+', '_', run.name).strip('_')
+            fname = '{}-{}-{}-{}-{:.0f}ms.pstats'.format(
+                run.kind, name, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), elapsed_ms)
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = os.path.join(self.path, '.tmp-' + fname)
+            stats.dump_stats(tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, fname))
+            logger.info(f"Profiled {run.kind} {run.name} in {elapsed_ms:.0f} ms to {fname}")
+            self._trim()
+        except Exception as e:
+            logger.error(f"Cannot write profile: {e}")
+
+    def _files(self) -> list:
+        return sorted((file for file in glob.glob(self.path + '/*.pstats') if os.path.isfile(file)),
+                      key=os.path.getmtime)
+
+    def _trim(self):
+        files = self._files()
+        for file in files[:max(0, len(files) - self._max_files)]:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    def profiles(self) -> list:
+        """Returns written profiles, newest first"""
+        res = []
+        for file in reversed(self._files()):
+            st = os.stat(file)
+            res.append({
+                'name': os.path.basename(file),
+                'bytes': st.st_size,
+                'at': datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc)
+                    .replace(microsecond=0).isoformat(),
+            })
+        return res
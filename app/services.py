@@ -1,180 +1,126 @@
+import contextlib
 import datetime
 import glob
+import json
 import logging
 import os
 import re
 import shutil
 import signal
-import subprocess
+import socket
 import sys
 import tempfile
 import time
+import uuid
 from typing import Optional
 
-import boto3
-import psutil
+from app.catalog import ROLLUP_PERIODS, Catalog, init_catalog
+from app.events import ARCHIVE_DONE, CHUNK_CLOSED, TIMELAPSE_DAILY, TIMELAPSE_ROLLUP, TIMELAPSE_SLOT, \
+    WATCHDOG_RESTART, publish
+from app.leases import Lease
+from app.procs import ProcResult, run_command
+from app.profiles import EncodeProfile, format_profile, parse_ladder
+from app.retention import CATEGORIES, Candidate, RetentionPolicy, sum_sizes
 
 logger = logging.getLogger(__name__)
 
 
-class VideoService:
-    """Service for actual video-related tasks and gathering statistics"""
+def parse_sources(sources: Optional[str]) -> list:
+    """Parses RTSP_SOURCES value 'name=rtsp://...,name2=rtsp://...' to a list of pairs"""
+    res = []
+    for item in (sources or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, url = item.partition('=')
+        if not sep or not name.strip() or not url.strip():
+            raise RuntimeError('Bad RTSP_SOURCES item ' + item)
+        if not re.fullmatch(r'[\w-]+', name.strip()):
+            raise RuntimeError('Stream name is used for directories, letters, digits, - and _ only: ' + item)
+        res.append((name.strip(), url.strip()))
+    if len({name for name, _ in res}) != len(res):
+        raise RuntimeError('Duplicate stream names in RTSP_SOURCES')
+    return res
 
-    def __init__(self, *args):
-        if args:
-            self.init_config(*args)
-        self._redis = None
-
-    def init_app(self, redis):
-        self._redis = redis
-
-    # noinspection PyAttributeOutsideInit
-    def init_config(self, config,
-                    raw_capture_path, timelapse_path, tmp_path, archive_path, damaged_path):
-        self.config = config
-        self.raw_capture_path = raw_capture_path
-        self.timelapse_path = timelapse_path
-        self.tmp_path = tmp_path
-        self.archive_path = archive_path
-        self.damaged_path = damaged_path
-        if not self.raw_capture_path or not os.path.isdir(self.raw_capture_path):
-            raise RuntimeError('Bad raw_capture_path')
-        if not self.timelapse_path or not os.path.isdir(self.timelapse_path):
-            raise RuntimeError('Bad timelapse_path')
-        if not self.archive_path or not os.path.isdir(self.archive_path):
-            raise RuntimeError('Bad archive_path')
-        if not self.damaged_path or not os.path.isdir(self.damaged_path):
-            raise RuntimeError('Bad damaged_path')
-        if self.config['ENABLE_S3'] and not self.config['BUCKET_NAME']:
-            raise RuntimeError('No bucket name')
-
-    def _enumerate_raw_files(self) -> list:
-        return list(sorted(file for file
-                           in glob.glob(self.raw_capture_path + '/*/*.mp4') +
-                           glob.glob(self.raw_capture_path + '/*/*.mkv')
-                           if os.path.isfile(file)))
-
-    def raw_count(self):
-        return len(self._enumerate_raw_files())
 
-    @staticmethod
-    def _parse_raw_dt(fname: str) -> datetime.datetime:
-        # out-20190602T1705.mp4
-        m = re.match(r'out-(.*)\.(mp4|mkv)', os.path.basename(fname))
-        if not m:
-            raise ValueError('Wrong filename')
-        return datetime.datetime.strptime(m.group(1), "%Y%m%dT%H%M")
-
-    @staticmethod
-    def _parse_timelapse_to_date_and_slot(fname: str) -> (datetime.date, int):
-        # timelapse-slots-20190602_3.mp4
-        m = re.match(r'timelapse-slots-(\d+)_(\d)\.(mp4|mkv)', os.path.basename(fname))
-        if not m:
-            raise ValueError('Wrong filename ' + fname)
-        date = datetime.datetime.strptime(m.group(1), "%Y%m%d").date()
-        slot = int(m.group(2))
-        # logger.debug(f"Res: {date!r} {slot!r}")
-        return date, slot
+class VideoService(Catalog):
+    """Service for actual video-related tasks"""
 
-    @staticmethod
-    def _parse_timelapse_daily_to_date(fname: str) -> datetime.date:
-        # timelapse-daily-20190602.mp4
-        m = re.match(r'timelapse-daily-(\d+)\.(mp4|mkv)', os.path.basename(fname))
-        if not m:
-            raise ValueError('Wrong filename ' + fname)
-        dt = datetime.datetime.strptime(m.group(1), "%Y%m%d").date()
-        # logger.debug(f"Res: {dt!r}")
-        return dt
-
-    def raw_last_at(self) -> Optional[datetime.datetime]:
-        files = self._enumerate_raw_files()
-        if len(files) < 2:
-            return None
-        last_completed_file = files[-1]
-        return self._parse_raw_dt(last_completed_file)
-
-    def timelapses_error_count(self):
-        return len([file for file
-                    in glob.glob(self.timelapse_path + '/*.err')
-                    if os.path.isfile(file)])
-
-    def timelapses_slots_count(self):
-        return len([file for file
-                    in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
-                    glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
-                    if os.path.isfile(file)])
-
-    def timelapses_daily_count(self):
-        return len([file for file
-                    in glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
-                    glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv')
-                    if os.path.isfile(file)])
-
-    def archives_count(self):
-        return len([file for file
-                    in glob.glob(self.archive_path + '/archive-*.ok')
-                    if os.path.isfile(file)])
-
-    def archives_error_count(self):
-        return len([file for file
-                    in glob.glob(self.archive_path + '/archive-*.err')
-                    if os.path.isfile(file)])
-
-    def timelapse_last_file(self):
-        files = sorted([file for file
-                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
-                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
-                        if os.path.isfile(file)])
-        if not files:
-            return None
-        return os.path.basename(files[-1])
-
-    def timelapse_last_at(self):
-        files = sorted([file for file
-                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
-                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
-                        if os.path.isfile(file)])
-        if not files:
-            return None
-        dt, _ = self._parse_timelapse_to_date_and_slot(files[-1])
-        return dt
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._retention = None
+        self._rollup_steps = {}
+        self._job_labels = {}
+        self._stream_services = None
 
-    def archive_last_file(self):
-        files = sorted([file for file
-                        in glob.glob(self.archive_path + '/archive-*.ok')
-                        if os.path.isfile(file)])
-        if not files:
-            return None
-        return os.path.basename(files[-1]).replace('.ok', '')
-
-    def get_timelapses_for_slot(self, date: datetime.date, slot: int) -> Optional[str]:
-        files = sorted([file for file
-                        in glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4') +
-                        glob.glob(self.timelapse_path + '/timelapse-slots-*.mkv')
-                        if os.path.isfile(file) and
-                        self._parse_timelapse_to_date_and_slot(file) == (date, slot)])
-        if not files:
-            return None
-        if len(files) > 1:
-            logger.warning(f"Multiple files matching slot {slot} and date {date.isoformat()} found")
-        return files[0]
-
-    def get_timelapses_for_date(self, date: datetime.date) -> Optional[str]:
-        files = sorted([file for file
-                        in glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
-                        glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv')
-                        if os.path.isfile(file) and
-                        self._parse_timelapse_daily_to_date(file) == date])
-        if not files:
+    def init_app(self, redis):
+        super().init_app(redis)
+        if self.config['ENABLE_RETENTION']:
+            self._retention = RetentionPolicy(self.config)
+        if self.config['ENABLE_ROLLUPS']:
+            self._rollup_steps = self._parse_rollup_steps(self.config['ROLLUP_FRAME_STEPS'])
+
+    def stream_services(self) -> list:
+        """Returns this service followed by services of extra streams from RTSP_SOURCES.
+        The first source is the primary stream captured to RAW_CAPTURE_PATH"""
+        if self._stream_services is None:
+            services = [self]
+            for name, _ in parse_sources(self.config['RTSP_SOURCES'])[1:]:
+                service = VideoService()
+                init_video_service(service, self.config, name)
+                service.init_app(self._redis)
+                services.append(service)
+            self._stream_services = services
+        return self._stream_services
+
+    def _owner(self, path: str) -> 'VideoService':
+        """Returns a service of a stream a file belongs to. Extra streams live below primary directories"""
+        for service in reversed(self.stream_services()):
+            if service._category(path):
+                return service
+        return self
+
+    CHUNK_SECONDS = 600
+
+    def _run(self, command: list, stage: str, capture_stdout: bool = False, on_stdout_line=None) -> ProcResult:
+        """Runs a child process and records its resource usage with labels of a current job"""
+        res = run_command(command, capture_stdout, on_stdout_line)
+        try:
+            self._job_history.record(stage, os.path.basename(command[0]), res, self._job_labels)
+        except Exception as e:
+            logger.error(f"Cannot record job history: {e}")
+        return res
+
+    @contextlib.contextmanager
+    def _job(self, job: str, **labels):
+        """Labels child processes launched within a block as a part of a job"""
+        prev_labels = self._job_labels
+        self._job_labels = dict(job=job, job_id=uuid.uuid4().hex[:12], node=self.node_name,
+                                **{k: v for k, v in dict(labels, stream=self.stream or None).items()
+                                   if v is not None})
+        try:
+            yield
+        finally:
+            self._job_labels = prev_labels
+
+    def _set_job_inputs(self, files: list, footage_s: float):
+        self._job_labels['input_bytes'] = sum(os.path.getsize(file) for file in files if os.path.isfile(file))
+        self._job_labels['footage_s'] = footage_s
+
+    @property
+    def node_name(self) -> str:
+        return self.config.get('NODE_NAME') or socket.gethostname()
+
+    def _job_key(self, kind: str, job: str) -> str:
+        return f'parklapse.job.{kind}.{self._stream_name(job)}'
+
+    def _claim_job(self, kind: str, job: str) -> Optional[Lease]:
+        """Claims a job lease so workers sharing the video volume do not encode the same output"""
+        lease = Lease(self._redis, self._job_key(kind, job), self.config['JOB_LEASE_TTL'], owner=self.node_name)
+        if not lease.acquire():
+            logger.info(f"Job {kind} {job} is claimed by another worker")
             return None
-        if len(files) > 1:
-            logger.warning(f"Multiple files matching date {date.isoformat()} found")
-        return files[0]
-
-    @staticmethod
-    def _timelapse_slot(dt: datetime.datetime) -> int:
-        """Returns index of three-hour interval (1 to 9)"""
-        return (dt.hour // 3) + 1
+        return lease
 
     def _make_fake_video(self, timelapse_video_name: str):
         timelapse_video_path = os.path.join(self.timelapse_path, timelapse_video_name)
@@ -199,24 +145,77 @@ class VideoService:
                 raise
             logger.info(f"Got composed video path: {concat_video_path}")
 
-            tmp_timelapse_video_path = os.path.join(tmpdirname, timelapse_video_name)
-            logger.info(f"Going to make timelapse video at: {tmp_timelapse_video_path}")
-            self._compose_timelapse_video(concat_video_path, tmp_timelapse_video_path)
-            logger.info(f"Video size: {os.stat(tmp_timelapse_video_path).st_size // (1024 * 1024)} MiB")
-            shutil.move(tmp_timelapse_video_path, self.timelapse_path)
+            with self._staged(self.timelapse_path, timelapse_video_name) as staging_video_path:
+                logger.info(f"Going to make timelapse video at: {staging_video_path}")
+                profile = self._choose_profile('timelapse')
+                elapsed = self._compose_timelapse_video(concat_video_path, staging_video_path, profile)
+                self._record_encode('timelapse', timelapse_video_name, profile, len(slot_files), elapsed)
+                logger.info(f"Video size: {os.stat(staging_video_path).st_size // (1024 * 1024)} MiB")
+                self._place(staging_video_path, os.path.join(self.timelapse_path, timelapse_video_name))
+
+    def _make_resumable_timelapse_video(self, slot_files: list, timelapse_video_name: str):
+        """Makes a slot timelapse from chunks encoded one by one, so a restarted job resumes"""
+        parts = self._encode_segments('timelapse', timelapse_video_name, slot_files, self._compose_timelapse_video)
+        with self._staged(self.timelapse_path, timelapse_video_name) as staging_video_path:
+            self._compose_copy_concat_video(parts, staging_video_path)
+            logger.info(f"Video size: {os.stat(staging_video_path).st_size // (1024 * 1024)} MiB")
+            self._place(staging_video_path, os.path.join(self.timelapse_path, timelapse_video_name))
+        self._remove_work_dir(os.path.splitext(timelapse_video_name)[0])
+
+    def _make_combined_videos(self, date: datetime.date, slot_files: list, timelapse_video_name: str):
+        """Makes a slot timelapse and archives for hours of the slot decoding each chunk once.
+
+        Every hour is encoded to a timelapse part and an archive rendition,
+        then parts are concatenated without recoding.
+        Hours already archived or claimed by another worker get a timelapse part only.
+        Outputs are placed when everything is encoded, a ledger marks each prepared archive."""
+        hours = sorted({self._parse_raw_dt(file).hour for file in slot_files})
+        timelapse_profile = self._choose_profile('timelapse')
+        archive_profile = self._choose_profile('archive')
+        with tempfile.TemporaryDirectory(prefix='parklapse-combined-', dir=self.tmp_path) as tmpdirname, \
+                contextlib.ExitStack() as leases:
+            timelapse_parts = []
+            archives = []
+            for hour in hours:
+                hour_files = [file for file in slot_files if self._parse_raw_dt(file).hour == hour]
+                archive_video_base = self._make_archive_video_base(date, hour)
+                archive_video_path = None
+                if not self._is_archive_done(date, hour):
+                    lease = self._claim_job('archive', archive_video_base)
+                    if lease:
+                        leases.enter_context(lease)
+                        archive_video_path = leases.enter_context(
+                            self._staged(self.archive_path, archive_video_base + '.mp4'))
+                        archives.append((archive_video_base, archive_video_path, hour_files))
+
+                timelapse_part_path = os.path.join(tmpdirname, f"timelapse-part_{hour:02d}.mp4")
+                logger.info(f"Going to make combined video for hour {hour}")
+                elapsed = self._compose_combined_video(hour_files, archive_video_path, timelapse_part_path,
+                                                       archive_profile, timelapse_profile)
+                self._record_encode('timelapse', timelapse_video_name, timelapse_profile, len(hour_files), elapsed)
+                if archive_video_path:
+                    self._record_encode('archive', archive_video_base + '.mp4', archive_profile, 0, elapsed)
+                timelapse_parts.append(timelapse_part_path)
+
+            staging_video_path = leases.enter_context(self._staged(self.timelapse_path, timelapse_video_name))
+            self._compose_copy_concat_video(timelapse_parts, staging_video_path)
+            logger.info(f"Video size: {os.stat(staging_video_path).st_size // (1024 * 1024)} MiB")
+
+            for archive_video_base, archive_video_path, hour_files in archives:
+                if not self._is_good_video(archive_video_path)[0]:
+                    raise RuntimeError('Archive video is not so good')
+                self._remove_prepared_ledger(archive_video_base)
+                self._place(archive_video_path, os.path.join(self.archive_path, archive_video_base + '.mp4'))
+                self._write_prepared_ledger(archive_video_base, hour_files, timelapse_video_name)
+            self._place(staging_video_path, os.path.join(self.timelapse_path, timelapse_video_name))
 
     def _make_daily_timelapse_video(self, timelapse_files: list, timelapse_video_name: str):
-        with tempfile.TemporaryDirectory(prefix='parklapse-daily-', dir=self.tmp_path) as tmpdirname:
-            tmp_video_path = os.path.join(tmpdirname, timelapse_video_name)
-            if os.path.isfile(tmp_video_path):
-                logger.warning(f'Removing existing target {tmp_video_path}')
-                os.remove(tmp_video_path)
-
-            self._compose_concat_video(timelapse_files, tmp_video_path)
-            logger.info(f"Got composed video path: {tmp_video_path}")
+        with self._staged(self.timelapse_path, timelapse_video_name) as staging_video_path:
+            self._compose_concat_video(timelapse_files, staging_video_path)
+            logger.info(f"Got composed video path: {staging_video_path}")
 
-            logger.info(f"Video size: {os.stat(tmp_video_path).st_size // (1024 * 1024)} MiB")
-            shutil.move(tmp_video_path, self.timelapse_path)
+            logger.info(f"Video size: {os.stat(staging_video_path).st_size // (1024 * 1024)} MiB")
+            self._place(staging_video_path, os.path.join(self.timelapse_path, timelapse_video_name))
 
     def _deduce_slot_files(self, dt: datetime.datetime, slot: int) -> Optional[list]:
         slot_files = sorted([file for file in self._enumerate_raw_files() if
@@ -243,6 +242,19 @@ class VideoService:
         return timelapse_files
 
     def produce_timelapse(self, dt: datetime.datetime, slot: int, read_only: bool, random_failure: bool) -> bool:
+        """Make a 3-hour timelapse for specific day and hourly slot.
+        Skip if timelapse exists or it is being made by another worker"""
+
+        timelapse_video_base = self._make_timelapse_video_base(dt, slot)
+        if os.path.isfile(os.path.join(self.timelapse_path, timelapse_video_base + '.mp4')):
+            return False
+        lease = self._claim_job('timelapse', timelapse_video_base)
+        if not lease:
+            return False
+        with lease, self._job('timelapse', date=dt.strftime('%Y%m%d'), slot=slot):
+            return self._produce_timelapse(dt, slot, read_only, random_failure)
+
+    def _produce_timelapse(self, dt: datetime.datetime, slot: int, read_only: bool, random_failure: bool) -> bool:
         """Make a 3-hour timelapse for specific day and hourly slot.
         Skip if timelapse exists, make a error file if generation failed or a video file if everything goes fine"""
 
@@ -279,10 +291,21 @@ class VideoService:
                     good_slot_files.append(slot_file)
                 elif not read_only:
                     logger.error(f"Bad video {slot_file}: {reason}, move out")
-                    shutil.move(slot_file, self.damaged_path)
+                    self._index_chunk(slot_file)
+                    self._place(slot_file, self.damaged_path)
 
+            self._set_job_inputs(good_slot_files, len(good_slot_files) * self.CHUNK_SECONDS)
             if not read_only:
-                self._make_timelapse_video(good_slot_files, slot, timelapse_video_base + '.mp4')
+                if self.config['ENABLE_COMBINED_ENCODE'] and self.config['ENABLE_ARCHIVE_COMPRESSION']:
+                    self._make_combined_videos(dt.date(), good_slot_files, timelapse_video_name)
+                elif self.config['ENABLE_RESUMABLE_ENCODE']:
+                    self._make_resumable_timelapse_video(good_slot_files, timelapse_video_name)
+                else:
+                    self._make_timelapse_video(good_slot_files, slot, timelapse_video_name)
+                if self.config['ENABLE_DECIMATION']:
+                    self._record_decimation(timelapse_video_name, len(good_slot_files))
+                publish(self._redis, TIMELAPSE_SLOT, date=dt.strftime('%Y%m%d'), slot=slot,
+                        name=self._stream_name(timelapse_video_name))
                 return True
 
         except Exception as e:
@@ -294,6 +317,54 @@ class VideoService:
                 f.write("Error: " + str(e) + "\n")
 
     def produce_daily_timelapse(self, date: datetime.date, read_only: bool, random_failure: bool) -> bool:
+        """Make a daily timelapse for specific day.
+        Skip if timelapse exists, it is being made by another worker or slots of the day are still in work"""
+
+        timelapse_video_base = self._make_timelapse_daily_video_base(date)
+        if os.path.isfile(os.path.join(self.timelapse_path, timelapse_video_base + '.mkv')):
+            return False
+        slot_jobs = [self._job_key('timelapse', self._make_timelapse_video_base(date, slot))
+                     for slot in range(1, 9)]
+        if self._redis.exists(*slot_jobs):
+            logger.info(f"Slots for {date.isoformat()} are in work, postpone daily timelapse")
+            return False
+        lease = self._claim_job('daily', timelapse_video_base)
+        if not lease:
+            return False
+        with lease, self._job('daily', date=date.strftime('%Y%m%d')):
+            return self._produce_daily_timelapse(date, read_only, random_failure)
+
+    def produce_urgent_timelapse(self, date: datetime.date, slot: Optional[int], read_only: bool):
+        """Urgent timelapse task. Makes a requested slot or daily timelapse with its slots ahead of the sweep"""
+        if slot:
+            timelapse_video_base = self._make_timelapse_video_base(date, slot)
+            job_keys = [self._job_key('timelapse', timelapse_video_base)]
+        else:
+            timelapse_video_base = self._make_timelapse_daily_video_base(date)
+            job_keys = [self._job_key('daily', timelapse_video_base)] + \
+                [self._job_key('timelapse', self._make_timelapse_video_base(date, s)) for s in range(1, 9)]
+        state_key = self._urgent_key(date, slot)
+        try:
+            self._redis.set(state_key, 'running', ex=self.config['URGENT_STATE_TTL'])
+            dt = datetime.datetime.combine(date, datetime.time())
+            for s in [slot] if slot else range(1, 9):
+                if self.is_slot_producible(date, s):
+                    self.produce_timelapse(dt, s, read_only, False)
+            if not slot:
+                self.produce_daily_timelapse(date, read_only, False)
+            if slot and self.get_timelapses_for_slot(date, slot) or \
+                    not slot and self.get_timelapses_for_date(date):
+                self._redis.delete(state_key)
+            elif self._redis.exists(*job_keys):
+                logger.info(f"Timelapse {timelapse_video_base} is being made by another worker")
+            elif not read_only:
+                raise RuntimeError('Timelapse cannot be made')
+        except Exception as e:
+            logger.error(str(e))
+            logger.exception(e)
+            self._redis.set(state_key, 'error: ' + str(e).splitlines()[0], ex=600)
+
+    def _produce_daily_timelapse(self, date: datetime.date, read_only: bool, random_failure: bool) -> bool:
         """Make a daily timelapse for specific day.
         Skip if timelapse exists, make a error file if generation failed or a video file if everything goes fine"""
 
@@ -323,8 +394,12 @@ class VideoService:
                 logger.info("Nothing to do")
                 return False
 
+            # every slot timelapse stands for three hours of footage
+            self._set_job_inputs(timelapse_files, len(timelapse_files) * 3 * 3600)
             if not read_only:
                 self._make_daily_timelapse_video(timelapse_files, timelapse_video_name)
+                publish(self._redis, TIMELAPSE_DAILY, date=date.strftime('%Y%m%d'),
+                        name=self._stream_name(timelapse_video_name))
                 return True
 
             return True
@@ -344,15 +419,6 @@ class VideoService:
             return '/usr/bin'
         raise RuntimeError('wrong platform')
 
-    @staticmethod
-    def _make_timelapse_video_base(dt: datetime.datetime, slot: int) -> str:
-        return "timelapse-slots-{}_{}".format(dt.strftime('%Y%m%d'),
-                                              slot)
-
-    @staticmethod
-    def _make_timelapse_daily_video_base(dt: datetime.date) -> str:
-        return "timelapse-daily-{}".format(dt.strftime('%Y%m%d'))
-
     @staticmethod
     def _make_archive_video_base(dt: datetime.date, hour: int) -> str:
         return "archive-{0}_{1:02d}".format(dt.strftime('%Y%m%d'), hour)
@@ -371,48 +437,547 @@ class VideoService:
             '-o',
             out_video_path])
         logger.info("Launching: " + " ".join(command))
-        res = subprocess.run(command, shell=False, check=False,
-                             stdout=None, stderr=subprocess.PIPE)
+        res = self._run(command, 'concat')
         if res.returncode != 0:
             raise RuntimeError('Concatenation failed ' + str(res.stderr.decode('latin-1')))
         logger.info("Succeed")
 
+    @contextlib.contextmanager
+    def _staged(self, dest_dir: str, name: str):
+        """Yields a hidden path to write an output on the filesystem of its destination.
+        The staging file is removed if it is not placed"""
+        staging_path = os.path.join(dest_dir, '.staging-' + name)
+        if os.path.isfile(staging_path):
+            logger.warning(f'Removing stale staging file {staging_path}')
+            os.remove(staging_path)
+        try:
+            yield staging_path
+        finally:
+            if os.path.isfile(staging_path):
+                os.remove(staging_path)
+
+    def _place(self, src: str, dst: str):
+        """Places a file and moves its bytes between usage categories"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        size = os.path.getsize(src)
+        replaced = os.path.getsize(dst) if os.path.isfile(dst) else 0
+        self._placer.place(src, dst)
+        self._usage.add(self._category(src), -size)
+        self._usage.add(self._category(dst), size - replaced)
+
+    def _remove(self, path: str):
+        size = os.path.getsize(path)
+        category = self._category(path)
+        os.unlink(path)
+        self._usage.add(category, -size)
+        if category == 'timelapse':
+            self._redis.hdel(self.DECIMATION_KEY, self._stream_name(os.path.basename(path)))
+        if self._profiles:
+            self._profiles.forget_used(self._stream_name(os.path.basename(path)))
+
+    def _account_created(self, path: str):
+        self._usage.add(self._category(path), os.path.getsize(path))
+
+    def _category(self, path: str) -> Optional[str]:
+        """Returns a usage category of a file by its directory. Hidden staging files are not counted"""
+        if os.path.basename(path).startswith('.'):
+            return None
+        directory = os.path.dirname(os.path.abspath(path))
+        for category, root in (('clips', self.clips_path),
+                               ('timelapse', self.timelapse_path),
+                               ('damaged', self.damaged_path),
+                               ('archive', self.archive_path),
+                               ('tmp', self.tmp_path)):
+            if directory == os.path.abspath(root):
+                return category
+        if directory.startswith(os.path.abspath(self.raw_capture_path) + os.sep):
+            return 'raw'
+        return None
+
+    @staticmethod
+    def _write_concat_list(files: list, list_path: str):
+        """Writes a file list for ffmpeg concat demuxer"""
+        with open(list_path, 'wt') as f:
+            for file in files:
+                escaped = os.path.abspath(file).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+    def _record_archive_rss(self, maxrss_kib: int):
+        """Keeps last and maximal peak RSS of archive jobs for worker sizing"""
+        self._redis.hset('parklapse.archive.rss', 'last', maxrss_kib)
+        max_rss = int(self._redis.hget('parklapse.archive.rss', 'max') or 0)
+        if maxrss_kib > max_rss:
+            self._redis.hset('parklapse.archive.rss', 'max', maxrss_kib)
+
     def _is_good_video(self, video_path: str) -> (bool, Optional[str]):
         if not video_path or not os.path.isfile(video_path):
             return False, None
 
         command = [os.path.join(self.local_bin(), 'ffprobe'), '-hide_banner', video_path]
-        res = subprocess.run(command, shell=False, check=False,
-                             stdout=None, stderr=subprocess.PIPE)
+        res = self._run(command, 'probe')
         if res.returncode != 0:
             return False, str(res.stderr.decode('latin-1'))
         return True, None
 
-    def _compose_timelapse_video(self, in_video_path: str, out_video_path: str):
+    TIMELAPSE_FPS = 24
+
+    TIMELAPSE_SPEEDUP = 60  # times
+
+    ARCHIVE_FILTER = 'fps=12,scale=1280:720,format=yuvj420p'
+
+    def _choose_profile(self, kind: str) -> Optional[EncodeProfile]:
+        """Returns an adaptive encode profile or None if static settings are used"""
+        if not self._profiles:
+            return None
+        profile = self._profiles.choose(kind)
+        logger.info(f"Using {kind} encode profile {format_profile(profile)}")
+        return profile
+
+    def _record_encode(self, kind: str, output_name: str, profile: Optional[EncodeProfile],
+                       chunks_count: int, elapsed: float):
+        """Records encode speed and a profile used for the output"""
+        if not self._profiles:
+            return
+        self._profiles.record_speed(kind, chunks_count * self.CHUNK_SECONDS, elapsed)
+        self._profiles.consume_backlog(self._stream_name(kind), chunks_count * self.CHUNK_SECONDS / 3600)
+        if profile:
+            self._profiles.record_used(self._stream_name(output_name), profile)
+
+    @staticmethod
+    def _profile_metadata(profile: Optional[EncodeProfile]) -> list:
+        if not profile:
+            return []
+        return ['-metadata', 'comment=parklapse-profile=' + format_profile(profile)]
+
+    def _timelapse_filter(self) -> str:
+        if not self.config['ENABLE_DECIMATION']:
+            return f"setpts=PTS/{self.TIMELAPSE_SPEEDUP}"
+        # sample frames like the plain speedup does, drop near-duplicates but not more than
+        # DECIMATION_MAX_DROP in a row so time still moves, then retime kept frames densely
+        fps = self.TIMELAPSE_FPS
+        return f"fps={fps}/{self.TIMELAPSE_SPEEDUP}," \
+               f"mpdecimate=max={int(self.config['DECIMATION_MAX_DROP'])}," \
+               f"setpts=N/{fps}/TB"
+
+    def _count_frames(self, video_path: str) -> int:
+        command = [os.path.join(self.local_bin(), 'ffprobe'),
+                   '-v', 'error',
+                   '-select_streams', 'v:0',
+                   '-count_packets',
+                   '-show_entries', 'stream=nb_read_packets',
+                   '-of', 'json',
+                   video_path]
+        res = self._run(command, 'probe', capture_stdout=True)
+        if res.returncode != 0:
+            raise RuntimeError('Probe failed ' + str(res.stderr.decode('latin-1')))
+        probe = json.loads(res.stdout.decode('utf-8'))
+        return int((probe.get('streams') or [{}])[0].get('nb_read_packets', 0))
+
+    def _record_decimation(self, timelapse_video_name: str, chunks_count: int):
+        """Records frames kept by decimation against frames of a plain speedup"""
+        expected = chunks_count * self.CHUNK_SECONDS * self.TIMELAPSE_FPS // self.TIMELAPSE_SPEEDUP
+        try:
+            kept = self._count_frames(os.path.join(self.timelapse_path, timelapse_video_name))
+        except Exception as e:
+            logger.error(f"Cannot count frames of {timelapse_video_name}: {e}")
+            return
+        logger.info(f"Decimation kept {kept} of {expected} frames")
+        self._redis.hset(self.DECIMATION_KEY, self._stream_name(timelapse_video_name), f'{kept}/{expected}')
+
+    def _timelapse_encode_options(self, profile: Optional[EncodeProfile] = None) -> list:
         bitrate = 4  # mbs
-        fps = 24
-        speedup = 60  # times
+        fps = self.TIMELAPSE_FPS
+        if profile:
+            rate_str = f"-preset {profile.preset} -crf {profile.crf} "
+        else:
+            rate_str = f"-preset slow -b:v {bitrate}M "
+        command_str = f"-r {fps} -c:v libx264 " + rate_str + \
+                      f"-maxrate {bitrate}M -bufsize {bitrate // 2}M " + \
+                      f"-g {fps} -keyint_min {fps} -force_key_frames expr:gte(t,n_forced*1)"
+        return command_str.split(' ') + self._profile_metadata(profile)
+
+    def _archive_encode_options(self, profile: Optional[EncodeProfile] = None) -> list:
+        # expr = '-c:v libx264 -crf 26 -maxrate 1000K -bufsize 1600K'
+        # expr = '-c:v libx264 -crf 24 -maxrate 1200K -bufsize 1700K'
+        expr = self.config['ARCHIVE_FFMPEG_ADJUSTMENTS']
+        if not expr:
+            raise RuntimeError('No archive ffmpeg string')
+        options = expr.split(' ')
+        if profile:
+            # profile overrides a preset and a CRF of configured adjustments
+            for name, value in (('-preset', profile.preset), ('-crf', str(profile.crf))):
+                if name in options:
+                    options[options.index(name) + 1] = value
+                else:
+                    options.extend([name, value])
+        return options + self._profile_metadata(profile)
+
+    def _probe_chunk(self, video_path: str) -> dict:
+        """Probes real duration, frame count and resolution of a closed chunk"""
+        command = [os.path.join(self.local_bin(), 'ffprobe'),
+                   '-v', 'error',
+                   '-select_streams', 'v:0',
+                   '-count_packets',
+                   '-show_entries', 'stream=width,height,nb_read_packets:format=duration,size',
+                   '-of', 'json',
+                   video_path]
+        res = self._run(command, 'index', capture_stdout=True)
+        stat_res = os.stat(video_path)
+        meta = {'start_ms': 0, 'duration_ms': 0, 'frames': 0, 'width': 0, 'height': 0,
+                'bytes': stat_res.st_size, 'ok': False}
+        if res.returncode == 0:
+            try:
+                probe = json.loads(res.stdout.decode('utf-8'))
+                stream = (probe.get('streams') or [{}])[0]
+                meta['duration_ms'] = int(float(probe.get('format', {}).get('duration', 0)) * 1000)
+                meta['frames'] = int(stream.get('nb_read_packets', 0))
+                meta['width'] = int(stream.get('width', 0))
+                meta['height'] = int(stream.get('height', 0))
+                meta['ok'] = meta['duration_ms'] > 0
+            except ValueError as e:
+                logger.warning(f"Cannot parse probe of {video_path}: {e}")
+
+        # filename has minute precision, chunk closing time minus duration is more exact
+        name_start_ms = int(self._parse_raw_dt(video_path).timestamp() * 1000)
+        closed_start_ms = int(stat_res.st_mtime * 1000) - meta['duration_ms']
+        meta['start_ms'] = closed_start_ms if abs(closed_start_ms - name_start_ms) < 120 * 1000 else name_start_ms
+        return meta
+
+    def _index_chunk(self, video_path: str) -> Optional[dict]:
+        """Stores metadata of a closed chunk unless it is known already"""
+        date = self._parse_raw_dt(video_path).date()
+        name = os.path.basename(video_path)
+        if self._chunk_index.has(date, name):
+            return None
+        meta = self._probe_chunk(video_path)
+        if not self._chunk_index.add(date, name, meta):
+            return None
+        self._usage.add('raw', meta['bytes'])
+        logger.info(f"Indexed chunk {name}: {meta!r}")
+        return meta
 
+    def index_chunks(self):
+        """Index task. Captures metadata of closed raw chunks, newest first.
+        A run probes at most INDEX_BATCH_SIZE chunks, a backlog is worked off by following runs"""
+        files = self._enumerate_raw_files()
+        known = {}
+        pending = []
+        # the last file is being written by a receiver
+        for file in files[:-1]:
+            date = self._parse_raw_dt(file).date()
+            if date not in known:
+                known[date] = self._chunk_index.names(date)
+            if os.path.basename(file) not in known[date]:
+                pending.append(file)
+        batch = pending[::-1][:int(self.config['INDEX_BATCH_SIZE'])]
+        if len(pending) > len(batch):
+            logger.info(f"Indexing {len(batch)} of {len(pending)} chunks, the rest is left to next runs")
+        for file in batch:
+            try:
+                with self._job('index', date=self._parse_raw_dt(file).strftime('%Y%m%d')):
+                    self._set_job_inputs([file], self.CHUNK_SECONDS)
+                    self._index_chunk(file)
+            except Exception as e:
+                logger.error(f"Cannot index chunk {file}: {e}")
+
+    def _find_clip_sources(self, from_dt: datetime.datetime, to_dt: datetime.datetime) -> list:
+        """Returns (path, inpoint, outpoint) seconds for raw chunks or hourly archives covering an interval.
+        Archives are re-encoded, so sources are all raw chunks or all archives, never mixed.
+        Archive positions are deduced from durations of chunks it was concatenated from"""
+        from_ms = int(from_dt.timestamp() * 1000)
+        to_ms = int(to_dt.timestamp() * 1000)
+        raw_files = {os.path.basename(file): file for file in self._enumerate_raw_files()}
+
+        raw_sources = []
+        archive_sources = []
+        date = from_dt.date()
+        while date <= to_dt.date():
+            chunks = sorted(self._chunk_index.for_date(date).items())
+            archive_offsets = {}
+            for name, meta in chunks:
+                if not meta['ok']:
+                    continue
+                hour = self._parse_raw_dt(name).hour
+                archive_offset_ms = archive_offsets.get(hour, 0)
+                archive_offsets[hour] = archive_offset_ms + meta['duration_ms']
+
+                start_ms = meta['start_ms']
+                end_ms = start_ms + meta['duration_ms']
+                if end_ms <= from_ms or start_ms >= to_ms:
+                    continue
+                inpoint_ms = max(from_ms, start_ms) - start_ms
+                outpoint_ms = min(to_ms, end_ms) - start_ms
+
+                archive_files = glob.glob(os.path.join(self.tmp_path,
+                                                       self._make_archive_video_base(date, hour) + '.*'))
+                if name not in raw_files and not archive_files:
+                    logger.warning(f"No raw file or archive for chunk {name}")
+                    continue
+                raw_sources.append((raw_files[name], inpoint_ms / 1000, outpoint_ms / 1000)
+                                   if name in raw_files else None)
+                if not archive_files:
+                    archive_sources.append(None)
+                    continue
+                path = archive_files[0]
+                inpoint_ms += archive_offset_ms
+                outpoint_ms += archive_offset_ms
+                if archive_sources and archive_sources[-1] and archive_sources[-1][0] == path and \
+                        abs(archive_sources[-1][2] * 1000 - inpoint_ms) < 1:
+                    # continue previous piece of the same archive
+                    archive_sources[-1] = (path, archive_sources[-1][1], outpoint_ms / 1000)
+                else:
+                    archive_sources.append((path, inpoint_ms / 1000, outpoint_ms / 1000))
+            date = date + datetime.timedelta(days=1)
+
+        if None not in raw_sources:
+            return raw_sources
+        if None not in archive_sources:
+            return archive_sources
+        raise RuntimeError('Interval spans raw chunks and archives being made, try again later')
+
+    def _evict_clips(self):
+        """Removes least recently used clips while the cache exceeds CLIPS_CACHE_BYTES"""
+        clips = sorted([(os.stat(file).st_mtime, os.stat(file).st_size, file)
+                        for file in glob.glob(self.clips_path + '/clip-*.mp4')
+                        if os.path.isfile(file)])
+        total = sum(size for _, size, _ in clips)
+        for _, size, file in clips:
+            if total <= int(self.config['CLIPS_CACHE_BYTES']):
+                break
+            logger.info(f"Evicting clip {file}")
+            self._remove(file)
+            total -= size
+
+    def make_clip(self, from_dt: datetime.datetime, to_dt: datetime.datetime):
+        """Clip task. Cuts an interval from raw chunks or archives at keyframes without recoding"""
+        with self._job('clip', date=from_dt.strftime('%Y%m%d')):
+            self._make_clip(from_dt, to_dt)
+
+    def _make_clip(self, from_dt: datetime.datetime, to_dt: datetime.datetime):
+        clip_name = self._make_clip_name(from_dt, to_dt)
+        state_key = 'parklapse.clip.' + clip_name
+        try:
+            if self.get_clip(from_dt, to_dt):
+                return
+            self._redis.set(state_key, 'running', ex=600)
+            os.makedirs(self.clips_path, exist_ok=True)
+
+            sources = self._find_clip_sources(from_dt, to_dt)
+            if not sources:
+                raise RuntimeError('No footage for the interval')
+            self._set_job_inputs([], sum(outpoint - inpoint for _, inpoint, outpoint in sources))
+            logger.info(f"Clip {clip_name} sources: {sources!r}")
+
+            clip_path = os.path.join(self.clips_path, clip_name)
+            tmp_clip_path = os.path.join(self.clips_path, '.tmp-' + clip_name)
+            concat_list_path = tmp_clip_path + '.concat'
+            with open(concat_list_path, 'wt') as f:
+                for path, inpoint, outpoint in sources:
+                    escaped = os.path.abspath(path).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\ninpoint {inpoint:.3f}\noutpoint {outpoint:.3f}\n")
+            command = [os.path.join(self.local_bin(), 'ffmpeg'),
+                       '-hide_banner',
+                       '-nostdin',
+                       '-y',
+                       '-f', 'concat',
+                       '-safe', '0',
+                       '-i', concat_list_path,
+                       '-map', '0:v:0',
+                       '-c', 'copy',
+                       '-movflags', '+faststart',
+                       tmp_clip_path]
+            logger.info("Launching: " + " ".join(command))
+            try:
+                res = self._run(command, 'cut')
+            finally:
+                os.remove(concat_list_path)
+            if res.returncode != 0:
+                if os.path.isfile(tmp_clip_path):
+                    os.remove(tmp_clip_path)
+                raise RuntimeError('Clip failed ' + str(res.stderr.decode('latin-1')))
+            os.replace(tmp_clip_path, clip_path)
+            self._account_created(clip_path)
+            logger.info(f"Clip {clip_name} is ready in {res.wall:.1f} seconds")
+            self._redis.delete(state_key)
+            self._evict_clips()
+        except Exception as e:
+            logger.error(str(e))
+            logger.exception(e)
+            self._redis.set(state_key, 'error: ' + str(e).splitlines()[0], ex=600)
+
+    def _compose_timelapse_video(self, in_video_path: str, out_video_path: str,
+                                 profile: Optional[EncodeProfile] = None) -> float:
         command = [os.path.join(self.local_bin(), 'ffmpeg')]
         command.extend(['-hide_banner',
                         '-nostdin',
                         '-i',
-                        in_video_path])
-        command_str = f"-vf setpts=PTS/{speedup} -r {fps} -c:v libx264 -preset slow " + \
-                      f"-b:v {bitrate}M -maxrate {bitrate}M -bufsize {bitrate // 2}M " + \
-                      f"-g {fps} -keyint_min {fps} -force_key_frames expr:gte(t,n_forced*1)"
-        command.extend(command_str.split(' '))
+                        in_video_path,
+                        '-vf',
+                        self._timelapse_filter()])
+        command.extend(self._timelapse_encode_options(profile))
         command.extend([
             out_video_path])
 
-        start_time = time.perf_counter()
         logger.info("Launching: " + repr(command))
-        res = subprocess.run(command, shell=False, check=False,
-                             stdout=None, stderr=subprocess.PIPE)
+        res = self._run(command, 'encode')
         if res.returncode != 0:
             raise RuntimeError('Recode failed ' + str(res.stderr.decode('latin-1')))
-        elapsed = time.perf_counter() - start_time
-        logger.info("Succeed timelapse in {} minutes".format(elapsed // 60))
+        logger.info("Succeed timelapse in {} minutes".format(res.wall // 60))
+        return res.wall
+
+    WORK_DIR_MAX_AGE = 2 * 24 * 3600  # seconds
+
+    def _work_dir(self, work_name: str) -> str:
+        return os.path.join(self.tmp_path, 'work', work_name)
+
+    def _remove_work_dir(self, work_name: str):
+        shutil.rmtree(self._work_dir(work_name), ignore_errors=True)
+
+    def _encode_segments(self, kind: str, output_name: str, files: list, encode) -> list:
+        """Encodes every chunk to a part in a persistent work directory and returns parts.
+
+        A manifest lists finished parts, so a job restarted after a worker crash or redeploy
+        encodes only missing parts. Parts are encoded with a profile pinned in the manifest
+        to be concatenated without recoding"""
+        work_name = os.path.splitext(output_name)[0]
+        work_dir = self._work_dir(work_name)
+        os.makedirs(work_dir, exist_ok=True)
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        manifest = None
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, 'rt') as f:
+                    manifest = json.load(f)
+            except ValueError as e:
+                logger.warning(f"Broken manifest {manifest_path}, starting over: {e}")
+        if manifest:
+            profile = parse_ladder(manifest['profile'])[0] if manifest['profile'] else None
+            logger.info(f"Resuming {work_name} with {len(manifest['parts'])} encoded parts")
+        else:
+            profile = self._choose_profile(kind)
+            manifest = {'profile': format_profile(profile) if profile else None, 'parts': {}}
+
+        parts = []
+        for file in files:
+            name = os.path.basename(file)
+            part_path = os.path.join(work_dir, os.path.splitext(name)[0] + '.mp4')
+            entry = manifest['parts'].get(name)
+            if not entry or entry['source_bytes'] != os.path.getsize(file) or not os.path.isfile(part_path):
+                tmp_part_path = os.path.join(work_dir, '.part-' + os.path.basename(part_path))
+                if os.path.isfile(tmp_part_path):
+                    os.remove(tmp_part_path)
+                elapsed = encode(file, tmp_part_path, profile)
+                self._record_encode(kind, output_name, profile, 1, elapsed)
+                os.replace(tmp_part_path, part_path)
+                manifest['parts'][name] = {'source_bytes': os.path.getsize(file),
+                                           'bytes': os.path.getsize(part_path)}
+                self._write_json_atomic(manifest_path, manifest)
+            parts.append(part_path)
+        return parts
+
+    def _cleanup_work_dirs(self, read_only: bool):
+        """Removes work directories of jobs abandoned long ago"""
+        for work_dir in glob.glob(os.path.join(self.tmp_path, 'work', '*')):
+            if os.path.isdir(work_dir) and time.time() - os.stat(work_dir).st_mtime > self.WORK_DIR_MAX_AGE:
+                logger.info(f"Cleaning abandoned work directory {work_dir}")
+                if not read_only:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _compose_archive_part(self, in_video_path: str, out_video_path: str,
+                              profile: Optional[EncodeProfile] = None) -> float:
+        command = [os.path.join(self.local_bin(), 'ffmpeg'),
+                   '-hide_banner',
+                   '-nostdin',
+                   '-threads',
+                   '1',
+                   '-i', in_video_path,
+                   '-map', '0:v:0',
+                   '-vf', self.ARCHIVE_FILTER]
+        command.extend(self._archive_encode_options(profile))
+        command.extend([out_video_path])
+        logger.info("Launching: " + " ".join(command))
+        res = self._run(command, 'encode')
+        if res.returncode != 0:
+            raise RuntimeError('Recode failed ' + str(res.stderr.decode('latin-1')))
+        self._record_archive_rss(res.maxrss)
+        return res.wall
+
+    def _compose_copy_concat_video(self, files: list, out_video_path: str):
+        """Concatenates videos with same codec parameters without recoding into any container"""
+        if not files:
+            raise RuntimeError('No files')
+
+        concat_list_path = out_video_path + '.concat'
+        self._write_concat_list(files, concat_list_path)
+        command = [os.path.join(self.local_bin(), 'ffmpeg'),
+                   '-hide_banner',
+                   '-nostdin',
+                   '-f', 'concat',
+                   '-safe', '0',
+                   '-i', concat_list_path,
+                   '-c', 'copy',
+                   out_video_path]
+        logger.info("Launching: " + " ".join(command))
+        try:
+            res = self._run(command, 'concat')
+        finally:
+            os.remove(concat_list_path)
+        if res.returncode != 0:
+            raise RuntimeError('Concatenation failed ' + str(res.stderr.decode('latin-1')))
+        logger.info("Succeed")
+
+    def _compose_combined_video(self, hour_files: list, archive_video_path: Optional[str],
+                                timelapse_video_path: str,
+                                archive_profile: Optional[EncodeProfile] = None,
+                                timelapse_profile: Optional[EncodeProfile] = None) -> float:
+        """Decodes chunks once and encodes both an archive and a timelapse renditions.
+        Archive rendition is skipped if archive_video_path is None"""
+        concat_list_path = timelapse_video_path + '.concat'
+        self._write_concat_list(hour_files, concat_list_path)
+        command = [os.path.join(self.local_bin(), 'ffmpeg'),
+                   '-hide_banner',
+                   '-nostdin',
+                   '-f', 'concat',
+                   '-safe', '0',
+                   '-i', concat_list_path]
+        if archive_video_path:
+            command.extend(['-filter_complex',
+                            f'[0:v:0]split=2[a][t];[a]{self.ARCHIVE_FILTER}[av];[t]{self._timelapse_filter()}[tv]',
+                            '-map', '[av]'])
+            command.extend(self._archive_encode_options(archive_profile))
+            command.extend([archive_video_path,
+                            '-map', '[tv]'])
+        else:
+            command.extend(['-map', '0:v:0',
+                            '-vf', self._timelapse_filter()])
+        command.extend(self._timelapse_encode_options(timelapse_profile))
+        command.extend([timelapse_video_path])
+
+        logger.info("Launching: " + " ".join(command))
+        try:
+            res = self._run(command, 'combined')
+        finally:
+            os.remove(concat_list_path)
+        if res.returncode != 0:
+            raise RuntimeError('Combined recode failed ' + str(res.stderr.decode('latin-1')))
+        logger.info("Succeed combined video in {} minutes, peak RSS {} MiB".format(res.wall // 60,
+                                                                                    res.maxrss // 1024))
+        return res.wall
+
+    def _timelapse_backlog_hours(self, first_dt: datetime.datetime, last_dt: datetime.datetime,
+                                 now: datetime.datetime) -> int:
+        """Counts footage hours of finished slots without a timelapse"""
+        backlog = 0
+        dt = first_dt
+        while dt < last_dt:
+            slot = self._timelapse_slot(dt)
+            timelapse_video_name = self._make_timelapse_video_base(dt, slot) + '.mp4'
+            if not (dt.date() == now.date() and slot == self._timelapse_slot(now)) and \
+                    not os.path.isfile(os.path.join(self.timelapse_path, timelapse_video_name)):
+                backlog += 1
+            dt = dt + datetime.timedelta(hours=1)
+        return backlog
 
     def check_timelapses(self, read_only: bool, random_failure: bool):
         """Timelapse task.
@@ -430,6 +995,9 @@ class VideoService:
 
         first_dt = self._parse_raw_dt(files[0])
         last_dt = self._parse_raw_dt(files[-2])
+        if self._profiles:
+            self._profiles.set_backlog(self._stream_name('timelapse'),
+                                       self._timelapse_backlog_hours(first_dt, last_dt, now))
         # run through them with a 1 hour stride
         dt = first_dt
         generated_slots_count = 0
@@ -467,20 +1035,122 @@ class VideoService:
 
         logger.info(f"Check done, generated {generated_daily_count} daily tl, checked {len(days)} days")
 
-        logger.info(f"Stats: success={self.timelapses_daily_count()} errors={self.timelapses_error_count()}")
+        if self.config['ENABLE_ROLLUPS']:
+            self.produce_rollups(read_only)
 
-    def provide_timelapse_slots(self) -> list:
-        return [(file, *self._parse_timelapse_to_date_and_slot(file))
-                for file
-                in sorted(glob.glob(self.timelapse_path + '/timelapse-slots-*.mp4'))
-                if os.path.isfile(file)]
+        logger.info(f"Stats: success={self.timelapses_daily_count()} errors={self.timelapses_error_count()}")
 
-    def provide_timelapse_daily(self) -> list:
-        return [(file, self._parse_timelapse_daily_to_date(file))
-                for file
-                in sorted(glob.glob(self.timelapse_path + '/timelapse-daily-*.mp4') +
-                          glob.glob(self.timelapse_path + '/timelapse-daily-*.mkv'))
-                if os.path.isfile(file)]
+    @staticmethod
+    def _parse_rollup_steps(steps: Optional[str]) -> dict:
+        """Parses frame steps of rollup periods 'weekly:1,monthly:4'"""
+        res = {}
+        for item in (steps or '').split(','):
+            item = item.strip()
+            if not item:
+                continue
+            period, sep, step = item.partition(':')
+            period = period.strip()
+            if not sep or period not in ROLLUP_PERIODS or int(step) < 1:
+                raise RuntimeError('Bad rollup frame step ' + item)
+            res[period] = int(step)
+        return res
+
+    def produce_rollups(self, read_only: bool) -> int:
+        """Adds finished daily timelapses to weekly and monthly rollups. Returns a number of added days"""
+        dailies = self.provide_timelapse_daily()
+        appended = 0
+        for period in ROLLUP_PERIODS:
+            by_key = {}
+            for file, date in dailies:
+                by_key.setdefault(self._make_rollup_key(period, date), []).append((date, file))
+            for key, key_dailies in sorted(by_key.items()):
+                appended += self.produce_rollup(period, key, sorted(key_dailies), read_only)
+        logger.info(f"Rollups done, added {appended} days")
+        return appended
+
+    def _pending_rollup_days(self, rollup_name: str, dailies: list) -> (list, Optional[list]):
+        """Returns dailies missing in a rollup and days already there or None if there is no rollup.
+        A late daily goes after the days already there, rebuilding would lose ones removed by retention"""
+        rollup_path = os.path.join(self.timelapse_path, rollup_name)
+        if not os.path.isfile(rollup_path):
+            return dailies, None
+        days = self.rollup_days(rollup_name)
+        if not days:
+            # the day list is lost, dailies made before the last update are in the rollup already
+            rollup_mtime = os.stat(rollup_path).st_mtime
+            days = [date.strftime('%Y%m%d') for date, file in dailies if os.stat(file).st_mtime <= rollup_mtime]
+            logger.warning(f"Days of {rollup_name} are unknown, assuming {','.join(days)}")
+        return [(date, file) for date, file in dailies if date.strftime('%Y%m%d') not in days], days
+
+    def produce_rollup(self, period: str, key: str, dailies: list, read_only: bool) -> int:
+        """Adds dailies of a rollup that are not there yet by a stream copy"""
+        rollup_name = self._make_rollup_video_base(period, key) + '.mkv'
+        if not self._pending_rollup_days(rollup_name, dailies)[0]:
+            return 0
+        if read_only:
+            logger.info(f"Pretending to update {rollup_name}")
+            return 0
+        lease = self._claim_job('rollup', self._make_rollup_video_base(period, key))
+        if not lease:
+            return 0
+        with lease, self._job('rollup', period=period, key=key):
+            # another worker could append meanwhile
+            pending, days = self._pending_rollup_days(rollup_name, dailies)
+            if not pending:
+                return 0
+            append = days is not None
+            days = days or []
+            if days and pending[0][0].strftime('%Y%m%d') < days[-1]:
+                logger.warning(f"Daily {pending[0][0].isoformat()} is older than {rollup_name} end, "
+                               f"adding it out of order")
+            logger.info(f"{'Extending' if append else 'Building'} {rollup_name} with {len(pending)} days")
+            self._set_job_inputs([file for _, file in pending], len(pending) * 24 * 3600)
+            try:
+                self._make_rollup_video([file for _, file in pending], rollup_name, append,
+                                        self._rollup_steps.get(period, 1))
+            except Exception as e:
+                logger.error(str(e))
+                logger.exception(e)
+                return 0
+            days += [date.strftime('%Y%m%d') for date, _ in pending]
+            self._redis.hset('parklapse.rollup.days', self._stream_name(rollup_name), ','.join(days))
+            self._write_json_atomic(self._rollup_days_path(rollup_name), {'days': days})
+            publish(self._redis, TIMELAPSE_ROLLUP, period=period, key=key, name=self._stream_name(rollup_name))
+            return len(pending)
+
+    def _make_rollup_video(self, daily_files: list, rollup_name: str, append: bool, frame_step: int):
+        """Concatenates a rollup with new dailies without recoding.
+        Matroska cannot be appended in place, so the existing rollup is copied into a new file
+        and each update reads and writes the whole rollup, cheap at timelapse bitrates.
+        With a frame step every daily is decimated once before it is added"""
+        rollup_path = os.path.join(self.timelapse_path, rollup_name)
+        with tempfile.TemporaryDirectory(prefix='parklapse-rollup', dir=self.tmp_path) as tmpdirname:
+            parts = [rollup_path] if append else []
+            for file in daily_files:
+                if frame_step > 1:
+                    part_path = os.path.join(tmpdirname, os.path.basename(file))
+                    self._decimate_video(file, part_path, frame_step)
+                    parts.append(part_path)
+                else:
+                    parts.append(file)
+            with self._staged(self.timelapse_path, rollup_name) as staging_video_path:
+                self._compose_concat_video(parts, staging_video_path)
+                logger.info(f"Video size: {os.stat(staging_video_path).st_size // (1024 * 1024)} MiB")
+                self._place(staging_video_path, rollup_path)
+
+    def _decimate_video(self, video_path: str, out_video_path: str, frame_step: int):
+        """Keeps every frame_step-th frame of a timelapse"""
+        command = [os.path.join(self.local_bin(), 'ffmpeg'),
+                   '-hide_banner', '-loglevel', 'error',
+                   '-i', video_path,
+                   '-an',
+                   '-vf', f"select=not(mod(n\\,{frame_step})),setpts=N/{self.TIMELAPSE_FPS}/TB"] + \
+                  self._timelapse_encode_options() + \
+                  ['-y', out_video_path]
+        logger.info("Launching: " + " ".join(command))
+        res = self._run(command, 'rollup')
+        if res.returncode != 0:
+            raise RuntimeError('Decimation failed ' + str(res.stderr.decode('latin-1')))
 
     def _is_archive_done(self, date: datetime.date, hour: int) -> bool:
         archive_video_base = self._make_archive_video_base(date, hour)
@@ -489,7 +1159,57 @@ class VideoService:
 
         return os.path.isfile(archive_status_path) or os.path.isfile(archive_error_path)
 
+    def _prepared_ledger_path(self, archive_video_base: str) -> str:
+        return os.path.join(self.archive_path, archive_video_base + '.pre')
+
+    def _is_prepared_archive(self, archive_video_base: str, files: list) -> bool:
+        """Checks if an archive was made by a combined encode from exactly these raw files"""
+        ledger_path = self._prepared_ledger_path(archive_video_base)
+        if not os.path.isfile(ledger_path) or \
+                not os.path.isfile(os.path.join(self.archive_path, archive_video_base + '.mp4')):
+            return False
+        with open(ledger_path, 'rt') as f:
+            ledger = json.load(f)
+        return ledger.get('sources') == [os.path.basename(file) for file in files]
+
+    def _remove_prepared_ledger(self, archive_video_base: str):
+        ledger_path = self._prepared_ledger_path(archive_video_base)
+        if os.path.isfile(ledger_path):
+            os.remove(ledger_path)
+
+    def _write_prepared_ledger(self, archive_video_base: str, files: list, timelapse_video_name: str):
+        """Atomically marks an archive made by a combined encode"""
+        self._write_json_atomic(self._prepared_ledger_path(archive_video_base),
+                                {'sources': [os.path.basename(file) for file in files],
+                                 'timelapse': timelapse_video_name,
+                                 'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+    @staticmethod
+    def _write_json_atomic(path: str, data: dict):
+        with open(path + '.tmp', 'wt') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
     def _generate_archive(self, date: datetime.date, hour: int, read_only: bool, enable_compression: bool) -> bool:
+        """Produce an archive for a specified day and hour unless another worker does it"""
+        if self._is_archive_done(date, hour):
+            return False
+        # archiving removes raw chunks, a slot timelapse being made of them on another host would lose inputs
+        slot_job_base = self._make_timelapse_video_base(date, self._timelapse_slot(datetime.datetime.combine(
+            date, datetime.time(hour))))
+        if self._redis.exists(self._job_key('timelapse', slot_job_base)):
+            logger.info(f"Slot timelapse {slot_job_base} is in work, postpone archive of hour {hour}")
+            return False
+        lease = self._claim_job('archive', self._make_archive_video_base(date, hour))
+        if not lease:
+            return False
+        with lease, self._job('archive', date=date.strftime('%Y%m%d'), hour=hour):
+            return self._generate_archive_claimed(date, hour, read_only, enable_compression)
+
+    def _generate_archive_claimed(self, date: datetime.date, hour: int, read_only: bool,
+                                  enable_compression: bool) -> bool:
         """Produce an archive for a specified day and hour"""
         archive_video_base = self._make_archive_video_base(date, hour)
         archive_status_path = os.path.join(self.archive_path, archive_video_base + '.ok')
@@ -507,52 +1227,51 @@ class VideoService:
         try:
             logging.info(f"Building archive for {date}:{hour}")
 
-            if os.path.isfile(archive_video_path):
-                logging.info("Already here, removing")
-                if not read_only:
-                    os.remove(archive_video_path)
-
             files = sorted([file for file in self._enumerate_raw_files() if
                             self._parse_raw_dt(file).date() == date and
                             self._parse_raw_dt(file).hour == hour and
                             self._is_good_video(file)])
 
+            prepared = enable_compression and self._is_prepared_archive(archive_video_base, files)
+            if os.path.isfile(archive_video_path) and not prepared:
+                logging.info("Already here, removing")
+                if not read_only:
+                    self._remove(archive_video_path)
+                    self._remove_prepared_ledger(archive_video_base)
+
             if not files:
                 return False
 
             logging.info("Files are: " + repr(files))
             logging.info("Target is: " + archive_video_path)
-
-            if enable_compression:
+            self._set_job_inputs(files, len(files) * self.CHUNK_SECONDS)
+
+            concat_list_path = os.path.join(self.archive_path, archive_video_base + '.concat')
+            resumable = enable_compression and not prepared and self.config['ENABLE_RESUMABLE_ENCODE']
+            if prepared:
+                logging.info("Archive is already prepared by a combined encode")
+                command = None
+            elif resumable:
+                logging.info("Archive is encoded by parts")
+                command = None
+            elif enable_compression:
+                # Chunks are decoded one after another by a concat demuxer,
+                # so memory does not depend on a number of chunks
+                # ffmpeg -f concat -safe 0 -i list.concat -map 0:v:0 \
+                # -vf fps=12,scale=1280:720,format=yuvj420p \
+                # -c:v libx264 -crf 26 -maxrate 1000K -bufsize 1600K output.mp4
                 command = [os.path.join(self.local_bin(), 'ffmpeg'),
                            '-hide_banner',
                            '-nostdin',
                            '-threads',
-                           '1']
-                # ffmpeg -i out-20190604T1706.mp4  -i out-20190604T1716.mp4  -filter_complex \
-                # "[0:v:0]fps=8,scale=1280:720,format=yuvj420p[v0];\
-                # [1:v:0]fps=8,scale=1280:720,format=yuvj420p[v1];\
-                # [v0][v1]concat=n=2:v=1[outv]" \
-                # -map "[outv]" -c:v libx264 -crf 26 -maxrate 1000K -bufsize 1600K output.mp4
-                for file in files:
-                    command.extend(['-i',
-                                    file])
-                filter_expr = ''
-                filter_expr += ''.join([str(f'[{m}:v:0]fps=12,scale=1280:720,format=yuvj420p[v{m}];')
-                                        for m, _ in enumerate(files)])
-                filter_expr += ''.join([str(f'[v{m}]')
-                                        for m, _ in enumerate(files)])
-                filter_expr += f'concat=n={len(files)}:v=1[outv]'
-                command.extend(['-filter_complex',
-                                filter_expr,
-                                '-map',
-                                '[outv]'])
-                # expr = '-c:v libx264 -crf 26 -maxrate 1000K -bufsize 1600K'
-                # expr = '-c:v libx264 -crf 24 -maxrate 1200K -bufsize 1700K'
-                expr = self.config['ARCHIVE_FFMPEG_ADJUSTMENTS']
-                if not expr:
-                    raise RuntimeError('No archive ffmpeg string')
-                command.extend(expr.split(' '))
+                           '1',
+                           '-f', 'concat',
+                           '-safe', '0',
+                           '-i', concat_list_path,
+                           '-map', '0:v:0',
+                           '-vf', self.ARCHIVE_FILTER]
+                profile = self._choose_profile('archive')
+                command.extend(self._archive_encode_options(profile))
                 command.extend([archive_video_path])
             else:
                 command = [os.path.join(self.local_bin(), 'mkvmerge')]
@@ -566,36 +1285,57 @@ class VideoService:
                     archive_video_path])
 
             if read_only:
-                logger.info("Pretending to launch: " + " ".join(command))
+                if command:
+                    logger.info("Pretending to launch: " + " ".join(command))
                 return True
 
-            start_time = time.perf_counter()
-            logger.info("Launching: " + " ".join(command))
-            res = subprocess.run(command, shell=False, check=False,
-                                 stdout=None, stderr=subprocess.PIPE)
-            if res.returncode != 0:
-                raise RuntimeError('Remux failed ' + str(res.stderr.decode('latin-1')))
-            elapsed = time.perf_counter() - start_time
-            logger.info("Succeed archive in {} minutes".format(elapsed // 60))
+            if resumable:
+                parts = self._encode_segments('archive', archive_video_base + extension, files,
+                                              self._compose_archive_part)
+                self._compose_copy_concat_video(parts, archive_video_path)
+                self._remove_work_dir(archive_video_base)
+
+            if command:
+                logger.info("Launching: " + " ".join(command))
+                try:
+                    if enable_compression:
+                        self._write_concat_list(files, concat_list_path)
+                    res = self._run(command, 'encode' if enable_compression else 'concat')
+                finally:
+                    if os.path.isfile(concat_list_path):
+                        os.remove(concat_list_path)
+                if res.returncode != 0:
+                    raise RuntimeError('Remux failed ' + str(res.stderr.decode('latin-1')))
+                logger.info("Succeed archive in {} minutes, peak RSS {} MiB".format(res.wall // 60,
+                                                                                 res.maxrss // 1024))
+                self._record_archive_rss(res.maxrss)
+                if enable_compression:
+                    self._record_encode('archive', archive_video_base + extension, profile, len(files), res.wall)
 
             if not self._is_good_video(archive_video_path):
                 raise RuntimeError('Archive video is not so good')
+            if command or resumable:
+                self._account_created(archive_video_path)
 
             if self.config.get('ENABLE_S3', False):
-                self._upload_to_s3(archive_video_base + extension, archive_video_path)
+                self._upload_to_s3(self._stream_name(archive_video_base + extension), archive_video_path)
                 logger.info("Uploaded to s3")
 
-            shutil.move(archive_video_path, self.tmp_path)
+            self._place(archive_video_path, self.tmp_path)
 
             # Mark as completed
             with open(archive_status_path, 'wt') as f:
                 f.write('ok')
+            self._remove_prepared_ledger(archive_video_base)
+            publish(self._redis, ARCHIVE_DONE, date=date.strftime('%Y%m%d'), hour=hour,
+                    name=self._stream_name(archive_video_base + extension))
 
             logger.info("Marked as completed")
 
             logger.info("Delete original files")
             for file in files:
-                os.unlink(file)
+                self._index_chunk(file)
+                self._remove(file)
 
             logger.info("Done archiving")
             return True
@@ -610,6 +1350,8 @@ class VideoService:
             return False
 
     def _upload_to_s3(self, name, path):
+        # boto3 is slow to import and needed only with ENABLE_S3
+        import boto3
         s3_client = boto3.client('s3')
         s3_client.upload_file(path, self.config['BUCKET_NAME'], name,
                               ExtraArgs={'StorageClass': self.config['BUCKET_STORAGE_CLASS']})
@@ -623,7 +1365,8 @@ class VideoService:
         # set umask for current and child processes
         os.umask(self.config['UMASK'])
 
-        dates = sorted(list({self._parse_raw_dt(file).date() for file in self._enumerate_raw_files()}))
+        raw_dts = [self._parse_raw_dt(file) for file in self._enumerate_raw_files()]
+        dates = sorted(list({dt.date() for dt in raw_dts}))
         logging.info(f"Found raw files for {len(dates)} dates: {repr(dates)}")
 
         dates = [date for date in dates
@@ -635,6 +1378,11 @@ class VideoService:
                                for hour in range(0, 24)
                                if not self._is_archive_done(date, hour)])
         logging.info(f"Remaining archive files: {remaining_count}")
+        if self._profiles:
+            self._profiles.set_backlog(self._stream_name('archive'),
+                                       len([1
+                                            for date, hour in {(dt.date(), dt.hour) for dt in raw_dts}
+                                            if date in dates and not self._is_archive_done(date, hour)]))
 
         for date in dates:
             for hour in range(0, 24):
@@ -647,6 +1395,7 @@ class VideoService:
     def _find_stream_process(self) -> Optional[int]:
         """Finds a ffmpeg process that receives RTSP.
         Heuristics - process name, current user"""
+        import psutil
         me = psutil.Process()
         username = me.username()
         target_pid = None
@@ -692,6 +1441,7 @@ class VideoService:
                     self._redis.incr('parklapse.watchdog.restarts')
                     logging.info(f'Found process {target_pid}')
                     os.kill(target_pid, signal.SIGKILL)
+                    publish(self._redis, WATCHDOG_RESTART, pid=target_pid, drift_minutes=drift.seconds // 60)
 
             if use_celery:
                 task_id_bytes = self._redis.get('parklapse.receive.task_id')  # type: bytes
@@ -702,6 +1452,7 @@ class VideoService:
                     self._redis.incr('parklapse.watchdog.restarts')
                     from app.celery import celery_app
                     celery_app.control.revoke(task_id, terminate=True)
+                    publish(self._redis, WATCHDOG_RESTART, task_id=task_id, drift_minutes=drift.seconds // 60)
 
         except Exception as e:
             logging.exception(e)
@@ -709,12 +1460,17 @@ class VideoService:
 
     def cleanup(self, read_only: bool):
         """Cleanup task that removes archives that had been uploaded
-        to S3 a few hours ago. Fresh archives are stored locally"""
-
-        tmp_archive_files = sorted([file for file
-                                    in glob.glob(self.tmp_path + '/archive-*.mp4') +
-                                    glob.glob(self.tmp_path + '/archive-*.mkv')
-                                    if os.path.isfile(file)])
+        to S3 a few hours ago. Fresh archives are stored locally.
+        Usage and retention cover all streams, they share a disk"""
+        for service in self.stream_services():
+            service._cleanup_stream(read_only)
+        if self._is_reconcile_due():
+            self.reconcile_usage()
+        if self._retention:
+            self._apply_retention(read_only)
+
+    def _cleanup_stream(self, read_only: bool):
+        tmp_archive_files = self._tmp_archive_files()
         keep = int(self.config['KEEP_ARCHIVE_FILES'])
         # leave only 'keep' last files, sorted array
         remove_files = tmp_archive_files[0:-keep]
@@ -723,24 +1479,128 @@ class VideoService:
             logging.info(f"Cleaning tmp archive {file}")
             if not read_only:
                 try:
-                    os.unlink(file)
+                    self._remove(file)
                 except OSError as e:
                     logging.error(str(e))
 
-    def receive(self, rtsp_source: Optional[str], task_id):
-        """Semi-infinite task that receives RTSP stream and saves
-        it to small ten-minute chunks to RAW_CAPTURE_PATH"""
-        if not rtsp_source:
-            return
-
-        self._redis.set('parklapse.receive.task_id', task_id)
+        self._cleanup_work_dirs(read_only)
+
+    def _tmp_archive_files(self) -> list:
+        return sorted([file for file
+                       in glob.glob(self.tmp_path + '/archive-*.mp4') +
+                       glob.glob(self.tmp_path + '/archive-*.mkv')
+                       if os.path.isfile(file)])
+
+    def _timelapse_files(self) -> list:
+        return sorted([file for file
+                       in glob.glob(self.timelapse_path + '/timelapse-*.mp4') +
+                       glob.glob(self.timelapse_path + '/timelapse-*.mkv')
+                       if os.path.isfile(file)])
+
+    def _category_files(self, categories=CATEGORIES) -> dict:
+        listings = {
+            'raw': self._enumerate_raw_files,
+            'timelapse': self._timelapse_files,
+            'damaged': lambda: [file for file in glob.glob(self.damaged_path + '/*') if os.path.isfile(file)],
+            'tmp': self._tmp_archive_files,
+            'archive': lambda: [file for file
+                                in glob.glob(self.archive_path + '/archive-*.mp4') +
+                                glob.glob(self.archive_path + '/archive-*.mkv')
+                                if os.path.isfile(file)],
+            'clips': lambda: [file for file in glob.glob(self.clips_path + '/clip-*.mp4') if os.path.isfile(file)],
+        }
+        return {category: listings[category]() for category in categories}
+
+    # seconds between evaluations of age limits, they need a listing of files
+    AGE_CHECK_INTERVAL = 3600
+
+    def _is_reconcile_due(self) -> bool:
+        """Usage is counted on every create and delete, a scan only repairs drift once in a while"""
+        if self._usage.drifted():
+            self._redis.delete('parklapse.usage.reconciled')
+        return bool(self._redis.set('parklapse.usage.reconciled', int(time.time()), nx=True,
+                                    ex=int(float(self.config['USAGE_RECONCILE_HOURS']) * 3600)))
+
+    def reconcile_usage(self):
+        """Replaces incrementally counted usage with a directory scan to repair drift.
+        Decimation and profiles of outputs removed behind our back are dropped too"""
+        stream_files = [(service, service._category_files()) for service in self.stream_services()]
+        usage = {category: sum(sum_sizes(category_files[category]) for _, category_files in stream_files)
+                 for category in CATEGORIES}
+        counted = self._usage.usage()
+        drift = {category: usage[category] - counted.get(category, 0) for category in CATEGORIES}
+        logger.info(f"Usage reconciled, drift {drift!r}")
+        self._usage.reset(usage)
+        names = {service._stream_name(os.path.basename(file))
+                 for service, category_files in stream_files
+                 for files in category_files.values() for file in files}
+        gone = [name for name in self._redis.hkeys(self.DECIMATION_KEY) if name.decode('latin-1') not in names]
+        if gone:
+            self._redis.hdel(self.DECIMATION_KEY, *gone)
+        logger.info(f"Dropped decimation of {len(gone)} removed timelapses")
+        if self._profiles:
+            dropped = self._profiles.trim_used(names)
+            logger.info(f"Dropped {dropped} profiles of removed outputs")
+
+    def _retention_candidates(self, categories: list) -> list:
+        """Files of categories of all streams that may be evicted.
+        Timelapses of yesterday and today are still in use. Timelapses of days with raw chunks
+        not archived yet are kept too, the timelapse task would encode them again"""
+        recent_date = datetime.date.today() - datetime.timedelta(days=1)
+        candidates = []
+        for service in self.stream_services():
+            files = service._category_files(categories)
+            if 'timelapse' in files:
+                raw_dates = {self._parse_raw_dt(file).date() for file in service._enumerate_raw_files()}
+                files['timelapse'] = [file for file in files['timelapse']
+                                      if self._timelapse_date(file) and self._timelapse_date(file) < recent_date and
+                                      self._timelapse_date(file) not in raw_dates]
+            for category in categories:
+                for file in files[category]:
+                    try:
+                        st = os.stat(file)
+                    except OSError:
+                        continue
+                    candidates.append(Candidate(category, file, st.st_size, st.st_mtime, st.st_dev))
+        return candidates
+
+    def _timelapse_date(self, fname: str) -> Optional[datetime.date]:
+        try:
+            if os.path.basename(fname).startswith('timelapse-daily-'):
+                return self._parse_timelapse_daily_to_date(fname)
+            return self._parse_timelapse_to_date_and_slot(fname)[0]
+        except ValueError:
+            return None
 
-        # set umask for current and child processes
-        os.umask(self.config['UMASK'])
+    def _apply_retention(self, read_only: bool):
+        """Evicts files by age limits, byte budgets and free space watermarks of the raw capture disk"""
+        free_bytes = shutil.disk_usage(self.raw_capture_path).free
+        usage = self._usage.usage()
+        check_ages = bool(self._redis.set('parklapse.retention.aged', int(time.time()), nx=True,
+                                          ex=self.AGE_CHECK_INTERVAL))
+        categories = self._retention.categories_to_scan(usage, free_bytes, check_ages)
+        if not categories:
+            logger.info(f"Nothing to evict, free {free_bytes // (1024 * 1024)} MiB")
+            return
+        plan = self._retention.plan(self._retention_candidates(categories), usage, free_bytes,
+                                    os.stat(self.raw_capture_path).st_dev, time.time())
+        logger.info(f"Should evict {len(plan)} files, free {free_bytes // (1024 * 1024)} MiB")
+        for candidate, reason in plan:
+            logger.info(f"Evicting {candidate.category} {candidate.path} by {reason}")
+            if not read_only:
+                try:
+                    self._owner(candidate.path)._remove(candidate.path)
+                    self._redis.hincrby('parklapse.retention.evicted', candidate.category, 1)
+                except OSError as e:
+                    logger.error(str(e))
 
-        out_dir = os.path.join(self.raw_capture_path, 'capture-' + datetime.datetime.now().strftime('%Y%m%dT%H%M'))
+    def make_receive_command(self, rtsp_source: str, raw_root: Optional[str] = None) -> list:
+        """Prepares a capture directory and returns ffmpeg command that saves
+        RTSP stream to ten-minute chunks there. Names of closed chunks are written to stdout"""
+        raw_root = raw_root or self.raw_capture_path
+        out_dir = os.path.join(raw_root, 'capture-' + datetime.datetime.now().strftime('%Y%m%dT%H%M'))
         if not os.path.isdir(out_dir):
-            os.mkdir(out_dir)
+            os.makedirs(out_dir)
 
         out_pattern = os.path.join(out_dir, 'out-%Y%m%dT%H%M.mp4')
         command = [os.path.join(self.local_bin(), 'ffmpeg')]
@@ -753,57 +1613,40 @@ class VideoService:
             rtsp_source,
             '-vcodec', 'copy',
             '-f', 'segment',
-            '-segment_time', '600',
+            '-segment_time', str(self.CHUNK_SECONDS),
             '-segment_format', 'mp4',
             '-reset_timestamps', '1',
             '-strftime', '1',
+            '-segment_list', 'pipe:1',
+            '-segment_list_type', 'flat',
             out_pattern])
-        logger.info("Launching receive command: " + " ".join(command))
-        res = subprocess.run(command, shell=False, check=False,
-                             stdout=None, stderr=subprocess.PIPE)
-        if res.returncode != 0:
-            raise RuntimeError('Receive failed ' + str(res.stderr.decode('latin-1')))
-        logger.info("Receive completed")
+        return command
 
+    def publish_chunk_closed(self, line: str, stream: Optional[str] = None):
+        """Publishes an event for a chunk name reported by a receiving ffmpeg"""
+        name = os.path.basename(line.strip())
+        if name:
+            publish(self._redis, CHUNK_CLOSED, name=name, stream=stream)
 
-class StatsService:
-    """Service for collecting statistics in a web-ready JSON using videoservice"""
+    def receive(self, rtsp_source: Optional[str], task_id):
+        """Semi-infinite task that receives RTSP stream and saves
+        it to small ten-minute chunks to RAW_CAPTURE_PATH"""
+        if not rtsp_source:
+            return
 
-    def __init__(self, redis):
-        self._redis = redis
+        self._redis.set('parklapse.receive.task_id', task_id)
 
-    def collect_stats(self, video_service: VideoService) -> dict:
-        stats = dict()
-        stats['alive'] = True
-        stats['stats_at'] = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
-        try:
-            stats['raw_count'] = video_service.raw_count()
-            if video_service.raw_last_at():
-                stats['raw_last_at'] = video_service.raw_last_at().replace(microsecond=0).isoformat()
-            stats['timelapses_daily_count'] = video_service.timelapses_daily_count()
-            stats['timelapses_success_count'] = video_service.timelapses_slots_count()
-            stats['timelapses_error_count'] = video_service.timelapses_error_count()
-            stats['timelapse_last_file'] = video_service.timelapse_last_file()
-            stats['archive_last_file'] = video_service.archive_last_file()
-            stats['archives_count'] = video_service.archives_count()
-            stats['archives_error_count'] = video_service.archives_error_count()
-            if video_service.timelapse_last_at():
-                stats['timelapse_last_at'] = video_service.timelapse_last_at().isoformat()
-            stats["free_disk"] = (psutil.disk_usage(video_service.raw_capture_path).free // (1024 * 1024 * 1024))
-            stats["restarts"] = int(self._redis.get('parklapse.watchdog.restarts') or '0')
-        except Exception as e:
-            logger.error("Exception happens: " + str(e))
-            logger.exception(e)
-            stats['error'] = str(e)
+        # set umask for current and child processes
+        os.umask(self.config['UMASK'])
 
-        stats = {k: v for k, v in stats.items() if v is not None}
-        return stats
+        command = self.make_receive_command(rtsp_source)
+        logger.info("Launching receive command: " + " ".join(command))
+        with self._job('receive'):
+            res = self._run(command, 'receive', on_stdout_line=self.publish_chunk_closed)
+        if res.returncode != 0:
+            raise RuntimeError('Receive failed ' + str(res.stderr.decode('latin-1')))
+        logger.info("Receive completed")
 
 
-def init_video_service(video_service, config):
-    video_service.init_config(config,
-                              config['RAW_CAPTURE_PATH'],
-                              config['TIMELAPSE_PATH'],
-                              config['TMP_PATH'],
-                              config['ARCHIVE_PATH'],
-                              config['DAMAGED_PATH'])
+def init_video_service(video_service, config, stream: str = ''):
+    init_catalog(video_service, config, stream)
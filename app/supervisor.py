@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+from typing import Optional
+
+from redis import Redis
+
+from app.config import Config
+from app.events import WATCHDOG_RESTART, publish
+from app.services import VideoService, init_video_service, parse_sources
+
+logger = logging.getLogger(__name__)
+
+
+class StreamReceiver:
+    """Runs ffmpeg for a single RTSP stream and restarts it when it exits
+    or when no segment is closed within MAX_DRIFT minutes"""
+
+    STDERR_TAIL = 20
+
+    def __init__(self, name: str, rtsp_source: str, raw_root: str,
+                 video_service: VideoService, redis, config):
+        self.name = name
+        self.rtsp_source = rtsp_source
+        self.raw_root = raw_root
+        self._video_service = video_service
+        self._redis = redis
+        self._backoff_base = float(config['SUPERVISOR_BACKOFF_BASE'])
+        self._backoff_max = float(config['SUPERVISOR_BACKOFF_MAX'])
+        self._stable_uptime = float(config['SUPERVISOR_STABLE_UPTIME'])
+        self._progress_deadline = float(config['MAX_DRIFT']) * 60
+        self._last_progress_at = 0.0
+        self._stderr_tail = collections.deque(maxlen=self.STDERR_TAIL)
+        self._proc = None  # type: Optional[asyncio.subprocess.Process]
+        self._stopping = asyncio.Event()
+
+    @property
+    def health_key(self) -> str:
+        return 'parklapse.supervisor.' + self.name
+
+    async def _publish(self, **fields):
+        """Publishes stream health to redis without blocking the loop"""
+        fields['updated_at'] = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+        mapping = {k: str(v) for k, v in fields.items() if v is not None}
+
+        def _write():
+            pipe = self._redis.pipeline()
+            pipe.sadd('parklapse.supervisor.streams', self.name)
+            pipe.hmset(self.health_key, mapping)
+            pipe.execute()
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write)
+        except Exception as e:
+            logger.error(f"[{self.name}] cannot publish health: {e}")
+
+    async def _incr_restarts(self, returncode: Optional[int]):
+        def _write():
+            self._redis.hincrby(self.health_key, 'restarts', 1)
+            self._redis.incr('parklapse.watchdog.restarts')
+            publish(self._redis, WATCHDOG_RESTART, stream=self.name, returncode=returncode)
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write)
+        except Exception as e:
+            logger.error(f"[{self.name}] cannot publish health: {e}")
+
+    async def _drain_stderr(self, stream: asyncio.StreamReader):
+        """Logs ffmpeg stderr line by line keeping only a short tail in memory"""
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # line is longer than a reader limit, skip it
+                continue
+            if not line:
+                break
+            text = line.decode('latin-1').rstrip()
+            if text:
+                self._stderr_tail.append(text)
+                logger.warning(f"[{self.name}] ffmpeg: {text}")
+
+    async def _drain_segments(self, stream: asyncio.StreamReader):
+        """Publishes events for chunks that ffmpeg reports as closed"""
+        loop = asyncio.get_event_loop()
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            self._last_progress_at = loop.time()
+            await loop.run_in_executor(None, self._video_service.publish_chunk_closed,
+                                       line.decode('latin-1'), self.name)
+
+    async def _watch_progress(self, proc: asyncio.subprocess.Process):
+        """Kills ffmpeg that is alive but closes no segments, a hung capture never exits by itself"""
+        loop = asyncio.get_event_loop()
+        while proc.returncode is None:
+            await asyncio.sleep(min(60.0, self._progress_deadline / 4))
+            if proc.returncode is None and loop.time() - self._last_progress_at > self._progress_deadline:
+                logger.error(f"[{self.name}] no segment closed for {self._progress_deadline:.0f} s, killing ffmpeg")
+                self._stderr_tail.append('Killed, no progress')
+                proc.kill()
+                return
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with a full jitter"""
+        ceiling = min(self._backoff_max, self._backoff_base * (2 ** attempt))
+        return random.uniform(self._backoff_base, max(self._backoff_base, ceiling))
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while not self._stopping.is_set():
+            started_at = loop.time()
+            try:
+                command = self._video_service.make_receive_command(self.rtsp_source, self.raw_root)
+                logger.info(f"[{self.name}] launching receive command: " + " ".join(command))
+                self._proc = await asyncio.create_subprocess_exec(*command,
+                                                                  stdin=subprocess.DEVNULL,
+                                                                  stdout=subprocess.PIPE,
+                                                                  stderr=subprocess.PIPE)
+            except OSError as e:
+                logger.error(f"[{self.name}] cannot launch ffmpeg: {e}")
+                returncode = None
+                self._stderr_tail.append(str(e))
+            else:
+                await self._publish(state='running', pid=self._proc.pid,
+                                    started_at=datetime.datetime.now().replace(microsecond=0).isoformat())
+                self._last_progress_at = loop.time()
+                drain = asyncio.gather(self._drain_stderr(self._proc.stderr),
+                                       self._drain_segments(self._proc.stdout))
+                watch = asyncio.ensure_future(self._watch_progress(self._proc))
+                returncode = await self._proc.wait()
+                watch.cancel()
+                await drain
+                self._proc = None
+
+            if self._stopping.is_set():
+                break
+
+            if loop.time() - started_at >= self._stable_uptime:
+                attempt = 0
+            delay = self._backoff_delay(attempt)
+            attempt += 1
+            logger.warning(f"[{self.name}] receiver exited with {returncode}, restarting in {delay:.1f} s")
+            await self._incr_restarts(returncode)
+            await self._publish(state='backoff', pid='', last_returncode=returncode,
+                                last_error=self._stderr_tail[-1] if self._stderr_tail else '',
+                                exited_at=datetime.datetime.now().replace(microsecond=0).isoformat())
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+        await self._publish(state='stopped', pid='')
+
+    def stop(self):
+        self._stopping.set()
+        if self._proc and self._proc.returncode is None:
+            # ffmpeg finalizes current segment on SIGTERM
+            self._proc.send_signal(signal.SIGTERM)
+
+
+class ReceiverSupervisor:
+    """Launches and monitors RTSP receivers within a single process.
+
+    The first stream writes to RAW_CAPTURE_PATH, others to RAW_CAPTURE_PATH/streams/<name>.
+    Timelapse, archive and index tasks process every stream with the same source list."""
+
+    def __init__(self, video_service: VideoService, redis, config):
+        sources = parse_sources(config['RTSP_SOURCES'])
+        self._receivers = [StreamReceiver(name, url, service.raw_capture_path, service, redis, config)
+                           for (name, url), service in zip(sources, video_service.stream_services())]
+
+    async def run(self):
+        if not self._receivers:
+            logger.error("No RTSP_SOURCES configured, nothing to supervise")
+            return
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        logger.info(f"Supervising {len(self._receivers)} streams")
+        await asyncio.gather(*[receiver.run() for receiver in self._receivers])
+        logger.info("Supervisor stopped")
+
+    def stop(self):
+        logger.info("Stopping receivers")
+        for receiver in self._receivers:
+            receiver.stop()
+
+
+def main():
+    logging.basicConfig(stream=sys.stdout,
+                        format='[%(asctime)s] %(name)s[%(process)d] %(levelname)s -- %(message)s',
+                        level='INFO')
+    config = {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+
+    # set umask for current and child processes
+    os.umask(config['UMASK'])
+
+    video_service = VideoService()
+    init_video_service(video_service, config)
+    redis = Redis.from_url(config['REDIS_URL'])
+    video_service.init_app(redis)
+
+    supervisor = ReceiverSupervisor(video_service, redis, config)
+    asyncio.get_event_loop().run_until_complete(supervisor.run())
+
+
+if __name__ == '__main__':
+    # Receiver supervisor entry point
+    main()
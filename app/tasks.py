@@ -1,7 +1,36 @@
+import datetime
+from typing import Optional
+
 from celery.utils.log import get_task_logger
 
 from app import video_service
 from app.celery import celery_app
+from app.leases import run_singleton
+
+CLIP_DT_FORMAT = '%Y%m%dT%H%M%S'
+
+
+SINGLETON_TASKS = ('timelapse', 'archive', 'cleanup', 'index')
+# Tasks without job leases run once in a cluster
+CLUSTER_SINGLETONS = ('cleanup', 'index')
+
+
+def singleton_name(name: str, node_name: str) -> str:
+    # Timelapse and archive singletons are per node, their jobs are distributed between nodes by job leases
+    return name if name in CLUSTER_SINGLETONS else f'{name}@{node_name}'
+
+
+def _run_singleton(name, func):
+    run_singleton(video_service.redis, singleton_name(name, video_service.node_name),
+                  celery_app.conf['SINGLETON_LEASE_TTL'], func)
+
+
+def _each_stream(func):
+    """Makes a run of a function for services of the primary and extra RTSP streams"""
+    def run():
+        for service in video_service.stream_services():
+            func(service)
+    return run
 
 
 @celery_app.task
@@ -14,7 +43,8 @@ def timelapse_task():
     logger = get_task_logger(timelapse_task.name)
     logger.info("Called timelapse_task")
 
-    video_service.check_timelapses(celery_app.conf['READ_ONLY'], False)
+    _run_singleton('timelapse',
+                   _each_stream(lambda service: service.check_timelapses(celery_app.conf['READ_ONLY'], False)))
 
 
 @celery_app.task(ignore_result=True)
@@ -22,8 +52,9 @@ def archive_task():
     logger = get_task_logger(archive_task.name)
     logger.info("Called archive_task")
 
-    video_service.archive(celery_app.conf['READ_ONLY'],
-                          celery_app.conf['ENABLE_ARCHIVE_COMPRESSION'])
+    _run_singleton('archive',
+                   _each_stream(lambda service: service.archive(celery_app.conf['READ_ONLY'],
+                                                                celery_app.conf['ENABLE_ARCHIVE_COMPRESSION'])))
 
 
 @celery_app.task(ignore_result=True)
@@ -40,7 +71,34 @@ def cleanup_task():
     logger = get_task_logger(cleanup_task.name)
     logger.info("Called cleanup_task")
 
-    video_service.cleanup(celery_app.conf['READ_ONLY'])
+    _run_singleton('cleanup',
+                   lambda: video_service.cleanup(celery_app.conf['READ_ONLY']))
+
+
+@celery_app.task(ignore_result=True)
+def index_task():
+    logger = get_task_logger(index_task.name)
+    logger.info("Called index_task")
+
+    _run_singleton('index', _each_stream(lambda service: service.index_chunks()))
+
+
+@celery_app.task(ignore_result=True)
+def clip_task(from_str: str, to_str: str):
+    logger = get_task_logger(clip_task.name)
+    logger.info(f"Called clip_task for {from_str} - {to_str}")
+
+    video_service.make_clip(datetime.datetime.strptime(from_str, CLIP_DT_FORMAT),
+                            datetime.datetime.strptime(to_str, CLIP_DT_FORMAT))
+
+
+@celery_app.task(ignore_result=True)
+def urgent_timelapse_task(date_str: str, slot: Optional[int]):
+    logger = get_task_logger(urgent_timelapse_task.name)
+    logger.info(f"Called urgent_timelapse_task for {date_str} slot {slot}")
+
+    video_service.produce_urgent_timelapse(datetime.datetime.strptime(date_str, '%Y%m%d').date(), slot,
+                                           celery_app.conf['READ_ONLY'])
 
 
 @celery_app.task(ignore_result=True, expires=60)
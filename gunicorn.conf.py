@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+# Web entry point: gunicorn -c gunicorn.conf.py start:app
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# threads wait for slow endpoints while their work runs on the offload pool
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = 60
+accesslog = '-'